@@ -1 +1 @@
-from . import helpers, gridtools, analysis
+from . import helpers, gridtools, analysis, aio, cache
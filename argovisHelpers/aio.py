@@ -0,0 +1,240 @@
+# asyncio versions of argofetch, query, queryProfile and queryGrid, for use from inside a running event loop.
+# these make the same requests and return the same results as their counterparts in helpers,
+# but wait on the network and on rate limiter backoff without blocking the loop, and can be cancelled;
+# building results and touching the caches shared with helpers, which take locks, are done in worker threads.
+# needs aiohttp, which is an optional dependency: pip install argovisHelpers[aio]
+
+import asyncio, copy, urllib
+from . import helpers
+
+def _aiohttp():
+    try:
+        import aiohttp
+    except ImportError as e:
+        raise ImportError('argovisHelpers.aio needs aiohttp; install it with pip install argovisHelpers[aio]') from e
+    return aiohttp
+
+def open_session(workers=4, timeout=(10, 300)):
+    # an aiohttp.ClientSession suitable for sharing across calls in this module, with at most <workers> connections
+    # and (connect, read) <timeout> seconds per request, in analogy to helpers.Client
+    aiohttp = _aiohttp()
+
+    return aiohttp.ClientSession(
+        connector=aiohttp.TCPConnector(limit=workers),
+        timeout=aiohttp.ClientTimeout(sock_connect=timeout[0], sock_read=timeout[1]),
+        headers={'x-avh-telemetry': helpers.telemetry_version()}
+    )
+
+async def acquire(limiter):
+    # wait for a token from a helpers.RateLimiter without blocking the event loop
+    wait = limiter.reserve()
+    while wait > 0:
+        await asyncio.sleep(wait)
+        wait = limiter.reserve()
+
+async def argofetch(route, options={}, apikey='', apiroot='https://argovis-api.colorado.edu/', suggestedLatency=0, verbose=False, limiter=None, session=None, retry=None):
+    # async helpers.argofetch; <session> is an aiohttp.ClientSession from open_session(), or None to open one just for this request.
+    # <retry> is the helpers.RetryPolicy to follow for server errors, timeouts and dropped connections, RetryPolicy() if None.
+
+    if session is None:
+        async with open_session() as s:
+            return await argofetch(route, options=options, apikey=apikey, apiroot=apiroot, suggestedLatency=suggestedLatency, verbose=verbose, limiter=limiter, session=s, retry=retry)
+
+    aiohttp = _aiohttp()
+    if retry is None:
+        retry = helpers.RetryPolicy()
+    params = {k: str(v) for k, v in options.items()}
+    url = apiroot.rstrip('/') + '/' + route.lstrip('/')
+    attempt = 0
+    while True:
+        if limiter is not None:
+            await acquire(limiter)
+        try:
+            async with session.get(url, params=params, headers={'x-argokey': apikey}) as response:
+                statuscode = response.status
+                if verbose:
+                    print(urllib.parse.unquote(str(response.url)))
+                decoder = helpers.StreamDecoder()
+                async for chunk in response.content.iter_chunked(helpers._STREAM_CHUNK):
+                    decoder.feed(chunk)
+        except (aiohttp.ClientConnectionError, aiohttp.ClientPayloadError, asyncio.TimeoutError) as e:
+            wait = retry.wait(attempt)
+            if wait is None:
+                raise
+            if verbose:
+                print(f'{type(e).__name__} on {url}, retrying in {wait:.1f} s')
+            await asyncio.sleep(wait)
+            attempt += 1
+            continue
+
+        try:
+            dl = decoder.result()
+        except ValueError:
+            dl = None # not JSON, like a page of HTML from a proxy
+
+        if statuscode == 429 and dl is not None:
+            # user exceeded API limit, extract suggested wait and delay times, and try again
+            wait = dl['delay'][0]
+            suggestedLatency = dl['delay'][1]
+            if limiter is not None:
+                limiter.throttle(wait*1.1, suggestedLatency)
+            else:
+                await asyncio.sleep(wait*1.1)
+            continue
+
+        if statuscode in retry.statuses:
+            wait = retry.wait(attempt)
+            if wait is not None:
+                if verbose:
+                    print(f'HTTP {statuscode}, retrying in {wait:.1f} s')
+                await asyncio.sleep(wait)
+                attempt += 1
+                continue
+
+        break
+
+    helpers.check_status(statuscode, dl, decoder.text())
+
+    return dl, suggestedLatency
+
+async def fetch_slice(route, options, spatial=None, apikey='', apiroot='https://argovis-api.colorado.edu/', verbose=False, limiter=None, session=None, sizer=None, retry=None):
+    # async helpers.fetch_slice: fetch one slice, splitting it up further if the API still says it's too big
+
+    if spatial is None:
+        return (await argofetch(route, options=options, apikey=apikey, apiroot=apiroot, verbose=verbose, limiter=limiter, session=session, retry=retry))[0]
+
+    if sizer is None:
+        sizer = helpers.default_sizer
+    r = route.strip('/')
+    bulk = await asyncio.to_thread(helpers.search_bulk, options, r)
+    try:
+        docs = (await argofetch(route, options=options, apikey=apikey, apiroot=apiroot, verbose=verbose, limiter=limiter, session=session, retry=retry))[0]
+    except Exception as e:
+        pieces = await asyncio.to_thread(helpers.split_slice, options, spatial) if e.args[0] == 413 else None
+        if pieces is None:
+            raise
+        sizer.rejected(r, bulk, apiroot)
+        docs = []
+        for piece in pieces:
+            docs += await fetch_slice(route, piece, spatial, apikey=apikey, apiroot=apiroot, verbose=verbose, limiter=limiter, session=session, retry=retry, sizer=sizer)
+        return docs
+
+    sizer.observe(r, bulk, len(docs), apiroot)
+    return docs
+
+async def fetch_slices(route, plan, apikey='', apiroot='https://argovis-api.colorado.edu/', verbose=False, workers=4, limiter=None, session=None, spatial=None, sizer=None, retry=None):
+    # async helpers.fetch_slices: fetch every option dict in <plan> with at most <workers> requests in flight,
+    # paced by one shared RateLimiter; returns the list of results for each slice, in plan order.
+    # if any slice fails or the caller is cancelled, every outstanding slice is cancelled.
+
+    if limiter is None:
+        limiter = helpers.RateLimiter()
+    semaphore = asyncio.Semaphore(workers)
+
+    async def fetch(ops):
+        async with semaphore:
+            return await fetch_slice(route, ops, spatial, apikey=apikey, apiroot=apiroot, verbose=verbose, limiter=limiter, session=session, retry=retry, sizer=sizer)
+
+    tasks = [asyncio.ensure_future(fetch(ops)) for ops in plan]
+    try:
+        return await asyncio.gather(*tasks)
+    finally:
+        for t in tasks:
+            t.cancel()
+
+async def query(route, options={}, apikey='', apiroot='https://argovis-api.colorado.edu/', verbose=False, slice=False, workers=4, session=None, retry=None):
+    # async helpers.query; <retry> is the helpers.RetryPolicy every request follows, as for argofetch
+
+    return (await search(route, options=options, apikey=apikey, apiroot=apiroot, verbose=verbose, slice=slice, workers=workers, session=session, retry=retry))[0]
+
+async def search(route, options={}, apikey='', apiroot='https://argovis-api.colorado.edu/', verbose=False, slice=False, workers=4, session=None, retry=None):
+    # async helpers.search: query, returning (results, the list of option dicts it was sliced into, or None if it didn't need slicing)
+
+    if session is None:
+        async with open_session(workers=workers) as s:
+            return await search(route, options=options, apikey=apikey, apiroot=apiroot, verbose=verbose, slice=slice, workers=workers, session=s, retry=retry)
+
+    # start by just trying the request, to determine if we need to slice it
+    if not slice:
+        try:
+            q = await argofetch(route, options=copy.deepcopy(options), apikey=apikey, apiroot=apiroot, verbose=verbose, session=session, retry=retry)
+            return q[0], None
+        except Exception as e:
+            if e.args[0] == 413:
+                # we need to slice
+                return await search(route=route, options=copy.deepcopy(options), apikey=apikey, apiroot=apiroot, verbose=verbose, slice=True, workers=workers, session=session, retry=retry)
+            else:
+                print(e)
+                return e.args, None
+
+    # slice request up into a series of requests; planning may need to look up time bounds and cut up polygons, so keep it off the loop
+    plan, spatial = await asyncio.to_thread(helpers.slice_plan, route, options, None, apiroot)
+    limiter = helpers.RateLimiter()
+    increments = await fetch_slices(route, plan, apikey=apikey, apiroot=apiroot, verbose=verbose, workers=workers, limiter=limiter, session=session, retry=retry, spatial=spatial)
+    results = [x for increment in increments for x in increment]
+
+    if spatial and 'batchmeta' not in options:
+        # smaller polygons will trace geodesics differently than full polygons, need to doublecheck
+        true_ids = await argofetch(route, options={**options, 'compression': 'minimal'}, apikey=apikey, apiroot=apiroot, verbose=verbose, limiter=limiter, session=session, retry=retry)
+        results, to_add = helpers.reconcile_slices(results, [x[0] for x in true_ids[0]])
+        for increment in await fetch_slices(route, helpers.missing_plan(options, to_add), apikey=apikey, apiroot=apiroot, verbose=verbose, workers=workers, limiter=limiter, session=session, retry=retry):
+            results += increment
+
+    # slicing can end up duplicating results in batchmeta requests, deduplicate
+    if 'batchmeta' in options:
+        results = list({x['_id']: x for x in results}.values())
+
+    return results, plan
+
+async def query_metadata(route, data, options={}, apikey='', apiroot='https://argovis-api.colorado.edu/', verbose=False, workers=4, session=None, plan=None, metadata=None, retry=None):
+    # async helpers.query_metadata, sharing its cache; reading and filling the cache takes its lock, so that's done off the loop.
+    # <metadata> is an optional cache.MetadataStore to keep the metadata documents in across processes, like helpers.Client's, and <retry> is as for query.
+
+    ids = helpers.metadata_ids(data)
+    found, todo = await asyncio.to_thread(helpers.cache_metadata, apiroot, route, ids, metadata)
+
+    async def fetch(metaroute, metaplan):
+        try:
+            for docs in await fetch_slices(metaroute, metaplan, apikey=apikey, apiroot=apiroot, verbose=verbose, workers=workers, session=session, retry=retry):
+                await asyncio.to_thread(helpers.store_metadata, apiroot, route, found, docs, metadata)
+        except Exception as e:
+            if verbose:
+                print(f'fetching metadata from {metaroute} failed ({e}), falling back to batchmeta')
+
+    if plan is not None and len(todo) > len(plan):
+        await fetch(route, [{**p, 'batchmeta': True} for p in plan])
+        todo = [id for id in todo if id not in found]
+    if plan is not None and 0 < len(todo) <= len(plan):
+        await fetch(helpers.metadata_route(route), [{'id': id} for id in todo])
+
+    if any(id not in found for id in ids):
+        meta = await query(route, options={**options, 'batchmeta':True}, apikey=apikey, apiroot=apiroot, verbose=verbose, workers=workers, session=session, retry=retry)
+        await asyncio.to_thread(helpers.store_metadata, apiroot, route, found, meta, metadata)
+        return meta
+    return [found[id] for id in ids]
+
+async def queryGrid(route, options={}, apikey='', apiroot='https://argovis-api.colorado.edu/', verbose=False, workers=4, session=None, dtype=float, metadata=None, retry=None):
+    # async helpers.queryGrid; <metadata> is as for query_metadata, and <retry> as for query
+
+    if session is None:
+        async with open_session(workers=workers) as s:
+            return await queryGrid(route, options=options, apikey=apikey, apiroot=apiroot, verbose=verbose, workers=workers, session=s, retry=retry, dtype=dtype, metadata=metadata)
+
+    griddata, plan = await search(route, options=options, apikey=apikey, apiroot=apiroot, verbose=verbose, workers=workers, session=session, retry=retry)
+    gridmeta = await query_metadata(route, griddata, options=options, apikey=apikey, apiroot=apiroot, verbose=verbose, workers=workers, session=session, retry=retry, plan=plan, metadata=metadata)
+
+    return await asyncio.to_thread(helpers.grid_dataset, griddata, gridmeta, options, dtype)
+
+async def queryProfile(route, options={}, apikey='', apiroot='https://argovis-api.colorado.edu/', verbose=False, workers=4, session=None, collection=False, metadata=None, retry=None):
+    # async helpers.queryProfile; <metadata> is as for query_metadata, and <retry> as for query
+
+    if session is None:
+        async with open_session(workers=workers) as s:
+            return await queryProfile(route, options=options, apikey=apikey, apiroot=apiroot, verbose=verbose, workers=workers, session=s, retry=retry, collection=collection, metadata=metadata)
+
+    data, plan = await search(route, options=options, apikey=apikey, apiroot=apiroot, verbose=verbose, workers=workers, session=session, retry=retry)
+    meta = await query_metadata(route, data, options=options, apikey=apikey, apiroot=apiroot, verbose=verbose, workers=workers, session=session, retry=retry, plan=plan, metadata=metadata)
+
+    if collection:
+        return await asyncio.to_thread(helpers.ProfileCollection.from_documents, data, meta)
+    return await asyncio.to_thread(helpers.profile_list, data, meta)
@@ -7,9 +7,10 @@
 # 32: insufficient levels for cacluation (interpolation or otherwise)
 # 512: no threshold crossing found in MLD estimation
 
-from .helpers import Profile
+from .helpers import Profile, ProfileCollection
+from . import helpers
 import scipy.interpolate
-import numpy, numbers, math, copy, gsw
+import numpy, numbers, math, copy, gsw, os, collections, concurrent.futures
 
 def MLD_estimate(pressure, var, threshold_delta, reference_pressure=10):
     # simple mixed layer depth estimator based on an absolute change in a variable relative to a reference pressure (default 10 dbar)
@@ -54,6 +55,83 @@ def AOU_estimate(SA, CT, p, lon, lat, oxygen):
 
     return O2_eq_umol_per_kg - oxygen, 0 # no flagging implemented but let's match MLD
 
+# TEOS-10 variables derive_teos10 can compute: each maps to the gsw function computing it, and the names of its arguments,
+# which are either other entries here, or measured 'salinity', 'temperature', 'oxygen', 'pressure', 'longitude' or 'latitude'.
+TEOS10 = {
+    'SA': (gsw.SA_from_SP, ('salinity', 'pressure', 'longitude', 'latitude')),
+    'CT': (gsw.CT_from_t, ('SA', 'temperature', 'pressure')),
+    'potential_temperature': (gsw.pt_from_CT, ('SA', 'CT')),
+    'sigma0': (gsw.sigma0, ('SA', 'CT')),
+    'rho': (gsw.rho, ('SA', 'CT', 'pressure')),
+    'O2sol': (gsw.O2sol, ('SA', 'CT', 'pressure', 'longitude', 'latitude')),
+    'AOU': (lambda o2sol, rho, oxygen: o2sol * rho / 1000 - oxygen, ('O2sol', 'rho', 'oxygen')), # as AOU_estimate
+}
+
+def teos10_arrays(measured, derived):
+    # the TEOS10 variables named in <derived>, computed from <measured>, a dict of arrays that broadcast together keyed like TEOS10's arguments;
+    # every variable is one gsw call over all the arrays at once, and intermediates like SA and CT are computed once and shared.
+    # returns a dict of every variable computed, intermediates included.
+
+    computed = dict(measured)
+    def compute(name):
+        if name not in computed:
+            if name not in TEOS10:
+                raise Exception(f'{name} is neither a TEOS-10 variable derive_teos10 knows nor available in the data.')
+            function, args = TEOS10[name]
+            computed[name] = function(*[compute(a) for a in args])
+        return computed[name]
+
+    for name in derived:
+        compute(name)
+    return {k: v for k, v in computed.items() if k not in measured}
+
+def teos10_inputs(name):
+    # the measured variables TEOS10 variable <name> depends on
+    if name not in TEOS10:
+        return {name}
+    return set().union(*[teos10_inputs(a) for a in TEOS10[name][1]])
+
+def derive_teos10(data, derived=('SA', 'CT', 'sigma0'), salinity='salinity', temperature='temperature', oxygen='doxy'):
+    # compute the TEOS-10 variables named in <derived>, like SA, CT, sigma0 or AOU (see TEOS10), for every profile and level in <data> at once,
+    # where <data> is either a ProfileCollection or an xarray.Dataset from build_dataset; <salinity>, <temperature> and <oxygen>
+    # name the practical salinity, in situ temperature and oxygen (umol/kg) variables in <data>.
+    # a ProfileCollection comes back as a new collection with the derived variables added, present for profiles with everything they need;
+    # a Dataset comes back as a new Dataset with the derived variables added, packed like the rest if it's packed (see pack_dataset).
+
+    names = {'salinity': salinity, 'temperature': temperature, 'oxygen': oxygen}
+    needed = set().union(*[teos10_inputs(d) for d in derived]) - {'pressure', 'longitude', 'latitude'}
+    missing = [names.get(n, n) for n in needed if names.get(n, n) not in (data.variable_names() if isinstance(data, ProfileCollection) else data.data_vars)]
+    if missing:
+        raise Exception(f'deriving {", ".join(derived)} needs {", ".join(sorted(missing))}, which the data does not have.')
+
+    if isinstance(data, ProfileCollection):
+        ## every level of every profile is one entry in the flat arrays, with each profile's location repeated over its levels
+        lengths = numpy.diff(data.offsets)
+        measured = {n: data.values[names.get(n, n)] for n in needed}
+        measured['pressure'] = data.values['pressure']
+        measured['longitude'] = numpy.repeat(data.longitudes, lengths)
+        measured['latitude'] = numpy.repeat(data.latitudes, lengths)
+        computed = teos10_arrays(measured, derived)
+
+        values = {**data.values, **{d: computed[d] for d in derived}}
+        present = dict(data.present)
+        for d in derived:
+            present[d] = numpy.logical_and.reduce([data.present[names.get(n, n)] for n in teos10_inputs(d) | {'pressure'} if n not in ('longitude', 'latitude')])
+        return ProfileCollection(data.rawdata, data.rawmeta, data.offsets, dict(sorted(values.items())), present)
+    else:
+        ## (nprof, level) blocks, against pressures along the levels and locations along the profiles
+        measured = {n: data[names.get(n, n)].values for n in needed}
+        measured['pressure'] = data['pressure'].values if 'pressure' in data.data_vars else data['levels'].values[None, :]
+        measured['longitude'] = data['longitude'].values[:, None]
+        measured['latitude'] = data['latitude'].values[:, None]
+        computed = teos10_arrays(measured, derived)
+
+        dtype = next(iter(data.data_vars.values())).dtype
+        shape = (data.sizes['nprof'], data.sizes['level'])
+        ds = data.assign({d: (('nprof', 'level'), numpy.broadcast_to(computed[d], shape).astype(dtype)) for d in derived})
+        packed = [data[v].encoding['dtype'] for v in data.data_vars if 'scale_factor' in data[v].encoding]
+        return helpers.pack_dataset(ds, packed[0]) if packed else ds
+
 
 def regional_mean(dxr, form='area'):
     # given an xarray dataset <dxr> with latitudes and longitudes as dimensions,
@@ -93,93 +171,380 @@ def interpolate_to_levels(levels_raw, var_raw, levels_interp):
 def is_numeric(x):
     return isinstance(x, numbers.Real) and not math.isnan(x) and math.isfinite(x) and not isinstance(x, bool)
 
+def numeric_values(x):
+    # <x> as an array of floats, and a boolean array marking which of its elements are numeric, as judged by is_numeric;
+    # masked elements of a masked array are not numeric.
+    if isinstance(x, numpy.ma.MaskedArray):
+        values, valid = numeric_values(x.data)
+        return values, valid & ~numpy.ma.getmaskarray(x)
+    a = numpy.asarray(x)
+    if a.dtype.kind in 'fiu':
+        values = a.astype(float).reshape(-1)
+        return values, numpy.isfinite(values)
+    # anything else, like lists with Nones or strings in them, has to be checked one element at a time
+    a = numpy.asarray(x, dtype=object).reshape(-1)
+    valid = numpy.array([is_numeric(v) for v in a], dtype=bool)
+    values = numpy.full(len(valid), numpy.nan)
+    values[valid] = [float(v) for v in a[valid]]
+    return values, valid
+
+def drop_degenerate(p, idx, flag):
+    # drop the levels indexed by <idx> whose pressure in <p> equals the next or previous one's, flagging if there were any
+    same = numpy.diff(p[idx]) == 0
+    if not same.any():
+        return idx, flag
+    drop = numpy.zeros(len(idx), dtype=bool)
+    drop[:-1] |= same
+    drop[1:] |= same
+    return idx[~drop], flag | 1
+
+def tidy_levels(p, keep, flag):
+    # indexes of the levels of the pressure array <p> that tidy_profile keeps, in the order it puts them in,
+    # starting from the boolean array <keep> of levels where both pressure and the variable are numeric; and flag, updated.
+
+    ## drop degenerate levels and flag
+    idx, flag = drop_degenerate(p, numpy.flatnonzero(keep), flag)
+
+    dp = numpy.diff(p[idx])
+    if (dp > 0).all():
+        # pressure is monotonically increasing
+        return idx, flag
+    if (dp < 0).all():
+        # pressure is monotonically decreasing, reverse
+        return idx[::-1], flag | 2
+    # pressure is non-monotonic, sort, after which levels can only have become degenerate
+    return drop_degenerate(p, idx[numpy.argsort(p[idx], kind='stable')], flag | 8)
+
+def tidy_flag(p_ok, v_ok, flag):
+    # flag missing values of the dependent variable, and missing pressures where it's defined
+    if not v_ok.all():
+        flag = flag | 4
+    if not p_ok[v_ok].all():
+        flag = flag | 16
+    return flag
+
 def tidy_profile(pressure, var, flag):
     # pchip needs pressures to be monotonically increasing; also need the dependent variable to always be defined
 
-    ## dependent variable must be defined
-    mask = [0]*len(var)
-    for i in range(len(var)):
-        if not is_numeric(var[i]):
-            mask[i] = 1
-            flag = flag | 4
-    p = [pressure[i] for i in range(len(mask)) if mask[i]==0]
-    v = [var[i] for i in range(len(mask)) if mask[i]==0]
-
-    ## pressure must be defined
-    mask = [0]*len(p)
-    for i in range(len(p)):
-        if not is_numeric(p[i]):
-            mask[i] = 1
-            flag = flag | 16
-    p = [p[i] for i in range(len(mask)) if mask[i]==0]
-    v = [v[i] for i in range(len(mask)) if mask[i]==0]
+    p, p_ok = numeric_values(pressure)
+    v, v_ok = numeric_values(var)
+    flag = tidy_flag(p_ok, v_ok, flag)
+    idx, flag = tidy_levels(p, v_ok & p_ok, flag)
 
-    ## drop degenerate levels and flag
-    mask = [0]*len(p)
-    for i in range(len(p)-1):
-        if p[i] == p[i+1]:
-            mask[i] = 1
-            mask[i+1] = 1
-            flag = flag | 1
-    p = [p[i] for i in range(len(mask)) if mask[i]==0]
-    v = [v[i] for i in range(len(mask)) if mask[i]==0]
-
-    if all(p[i] < p[i + 1] for i in range(len(p) - 1)):
-        # pressure is monotonically increasing, return
-        return p, v, flag
-
-    if all(p[i] > p[i + 1] for i in range(len(p) - 1)):
-        # pressure is monotonically decreasing, reverse and return
-        flag = flag | 2
-        return p[::-1], v[::-1], flag
-
-    # pressure is non-monotonic, sort and try again
-    x = sorted(zip(p,v))
-    p = [element[0] for element in x]
-    v = [element[1] for element in x]
-    flag = flag | 8
-    return tidy_profile(p,v,flag)
+    return p[idx].tolist(), v[idx].tolist(), flag
 
-def mask_far_interps(measured_pressures, interp_levels, interp_values):
-    # mask interpolated values that are too far from the nearest measured level
-    # or which fall outside range of measured levels
+def far_levels(measured_pressures, interp_levels):
+    # boolean array marking the <interp_levels> that mask_far_interps masks, given increasing <measured_pressures>
 
-    mask = [False for x in interp_levels]
+    measured_pressures = numpy.asarray(measured_pressures, dtype=float)
+    levels = numpy.asarray(interp_levels, dtype=float)
 
-    for i, level in enumerate(interp_levels):
-        ## mask out anything that was extrapolated:
-        if interp_levels[i] < measured_pressures[0] or interp_levels[i] > measured_pressures[-1]:
-            mask[i] = True
-            continue
+    ## mask out anything that was extrapolated:
+    mask = (levels < measured_pressures[0]) | (levels > measured_pressures[-1])
 
-        ## determine how far is too far when interpolating to interiror holes:
-        radius = 0
-        if level < 50:
-            radius = 50
-        elif level < 150:
-            radius = 150
-        else:
-            radius = 500
+    ## determine how far is too far when interpolating to interiror holes:
+    radius = numpy.where(levels < 50, 50, numpy.where(levels < 150, 150, 500))
 
-        i_below = 0
-        i_above = len(measured_pressures)-1
-        for j in range(len(measured_pressures)):
-            if measured_pressures[j] <= level:
-                i_below = j
-            else:
-                i_above = j
-                break
-        if abs(measured_pressures[i_below] - level) > radius or abs(measured_pressures[i_above] - level) > radius:
-            mask[i] = True
+    ## nearest measured levels at or below, and above, each level
+    i_above = numpy.searchsorted(measured_pressures, levels, side='right')
+    i_below = numpy.maximum(i_above - 1, 0)
+    i_above = numpy.minimum(i_above, len(measured_pressures) - 1)
+    mask |= (numpy.abs(measured_pressures[i_below] - levels) > radius) | (numpy.abs(measured_pressures[i_above] - levels) > radius)
+
+    return mask
 
-    return numpy.ma.masked_array(interp_values, mask=mask)
+def mask_far_interps(measured_pressures, interp_levels, interp_values):
+    # mask interpolated values that are too far from the nearest measured level
+    # or which fall outside range of measured levels
 
-def interpolate_all(profile, levels):
+    return numpy.ma.masked_array(interp_values, mask=far_levels(measured_pressures, interp_levels))
+
+def pchip_slopes(x, y, first, last):
+    # derivatives at every point of many curves at once, exactly as scipy.interpolate.PchipInterpolator finds them for each curve:
+    # <x> and <y> are every curve's points one after another, each curve with at least two points and increasing x,
+    # <first> and <last> are boolean arrays marking each curve's first and last points, and y may have a column per variable.
+
+    x = x.reshape((-1,) + (1,)*(y.ndim - 1))
+    with numpy.errstate(divide='ignore', invalid='ignore'):
+        # intervals from one curve's last point to the next curve's first are meaningless, but never used
+        h = numpy.diff(x, axis=0)
+        m = numpy.diff(y, axis=0) / h
+    d = numpy.zeros_like(y)
+
+    ## interior points: weighted harmonic mean of neighboring slopes, or 0 at extrema and flats
+    q = numpy.flatnonzero(~first & ~last)
+    mp, mn, hp, hn = m[q-1], m[q], h[q-1], h[q]
+    condition = (numpy.sign(mp) != numpy.sign(mn)) | (mn == 0) | (mp == 0)
+    w1 = 2*hn + hp
+    w2 = hn + 2*hp
+    with numpy.errstate(divide='ignore', invalid='ignore'):
+        whmean = (w1/mp + w2/mn) / (w1 + w2)
+        d[q] = numpy.where(condition, 0.0, 1.0 / whmean)
+
+    ## endpoints: one-sided three-point estimate, or the slope between them for two point curves
+    two = first[:-1] & last[1:]
+    for ends, inner, outer in ((numpy.flatnonzero(first), 0, 1), (numpy.flatnonzero(last), -1, -2)):
+        pair = two[ends] if inner == 0 else two[ends-1]
+        i0 = ends + inner # interval next to the endpoint
+        i1 = ends + outer # and the one after that
+        h0, h1, m0, m1 = h[i0], h[numpy.where(pair, i0, i1)], m[i0], m[numpy.where(pair, i0, i1)]
+        with numpy.errstate(divide='ignore', invalid='ignore'):
+            e = ((2*h0 + h1)*m0 - h0*m1) / (h0 + h1)
+        e = numpy.where(numpy.sign(e) != numpy.sign(m0), 0.0, numpy.where((numpy.sign(m0) != numpy.sign(m1)) & (numpy.abs(e) > 3.*numpy.abs(m0)), 3.*m0, e))
+        d[ends] = numpy.where(pair.reshape(h0.shape[:1] + (1,)*(y.ndim - 1)), m0, e)
+
+    return d
+
+class PchipCurves:
+    # PCHIP fits of many profiles' variables at once, as interpolate_to_levels and MLD_estimate make them one at a time:
+    # <pressures> is a list of each profile's pressure vector, and <variables> a dict mapping variable names to lists of each profile's
+    # vector of that variable, None where a profile doesn't have it. each profile is tidied as tidy_profile would; its pressures are
+    # converted once, and its variables left on the same measured levels, usually all of them, share one tidy_levels and make up one curve.
+    # every curve's levels are in one flat array x, curve c's being x[start[c]:start[c]+count[c]], with values y[:, j] of the j-th variable,
+    # nan for variables not on the curve, and PCHIP slopes d, found for every curve together.
+    # owner[c] is the profile curve c came from, and on[c, j] whether variable j is on it; flags[name] has each profile's tidy flags,
+    # with 32 where a variable was left with fewer than two levels to fit, in which case it's left off the curves.
+
+    def __init__(self, pressures, variables):
+        self.names = list(variables)
+        self.flags = {name: numpy.zeros(len(pressures), dtype=int) for name in self.names}
+        xs, ys, owner, on = [], [], [], []
+        for i, pressure in enumerate(pressures):
+            p, p_ok = numeric_values(pressure)
+
+            ## group this profile's variables by the levels they keep
+            groups = {}
+            for j, name in enumerate(self.names):
+                var = variables[name][i]
+                if var is None:
+                    continue
+                v, v_ok = numeric_values(var)
+                keep = v_ok & p_ok
+                groups.setdefault((keep.tobytes(), tidy_flag(p_ok, v_ok, 0)), []).append((j, v))
+
+            for (keep, flag), group in groups.items():
+                idx, flag = tidy_levels(p, numpy.frombuffer(keep, dtype=bool), flag)
+                if len(idx) < 2:
+                    flag = flag | 32
+                for j, v in group:
+                    self.flags[self.names[j]][i] = flag
+                if len(idx) < 2:
+                    continue
+                y = numpy.full((len(idx), len(self.names)), numpy.nan)
+                member = numpy.zeros(len(self.names), dtype=bool)
+                for j, v in group:
+                    y[:, j] = v[idx]
+                    member[j] = True
+                xs.append(p[idx])
+                ys.append(y)
+                owner.append(i)
+                on.append(member)
+
+        self.count = numpy.array([len(x) for x in xs], dtype=numpy.int64)
+        self.start = numpy.cumsum(self.count) - self.count
+        self.x = numpy.concatenate(xs) if len(xs) > 0 else numpy.empty(0)
+        self.y = numpy.concatenate(ys) if len(ys) > 0 else numpy.empty((0, len(self.names)))
+        self.owner = numpy.array(owner, dtype=numpy.int64)
+        self.on = numpy.array(on, dtype=bool).reshape(-1, len(self.names))
+
+        first = numpy.zeros(len(self.x), dtype=bool)
+        first[self.start] = True
+        last = numpy.zeros(len(self.x), dtype=bool)
+        last[self.start + self.count - 1] = True
+        self.d = pchip_slopes(self.x, self.y, first, last)
+
+    def __len__(self):
+        return len(self.count)
+
+    def bracket(self, levels):
+        # for every curve and each of <levels>, the index into x of the measured level starting the interval PchipInterpolator
+        # would evaluate it in, and whether mask_far_interps would mask it, as two (curve, level) arrays
+        levels = numpy.asarray(levels, dtype=float)
+        below = numpy.array([numpy.searchsorted(self.x[a:a+n], levels, side='right') for a, n in zip(self.start, self.count)], dtype=numpy.int64).reshape(-1, len(levels))
+        below = self.start[:, None] + below # first measured level above each level, then the one at or below it
+        lo, hi = self.start[:, None], (self.start + self.count - 1)[:, None]
+        above = numpy.minimum(below, hi)
+        below = numpy.maximum(below - 1, lo)
+
+        radius = numpy.where(levels < 50, 50, numpy.where(levels < 150, 150, 500))
+        far = (levels < self.x[lo]) | (levels > self.x[hi]) | (numpy.abs(self.x[below] - levels) > radius) | (numpy.abs(self.x[above] - levels) > radius)
+        return numpy.minimum(below, hi - 1), far
+
+    def coefficients(self, k, j):
+        # the cubic coefficients PchipInterpolator evaluates on the intervals starting at the levels indexed by <k>, for variable <j>
+        h = self.x[k+1] - self.x[k]
+        y0, y1, d0, d1 = self.y[k, j], self.y[k+1, j], self.d[k, j], self.d[k+1, j]
+        slope = (y1 - y0) / h
+        t = (d0 + d1 - 2*slope) / h
+        return t / h, (slope - d0)/h - t, d0, y0
+
+    def evaluate(self, k, s, j):
+        # variable <j> at distance <s> past the levels indexed by <k>, summed the way PchipInterpolator does
+        c0, c1, c2, c3 = self.coefficients(k, j)
+        return c3 + c2*s + c1*(s*s) + c0*(s*s*s)
+
+def interpolate_profiles(pressures, variables, levels):
+    # interpolate_to_levels for many profiles and variables at once, taking the same <pressures> and <variables> as PchipCurves:
+    # each profile's pressures are converted once, and its variables left on the same measured levels after tidying share
+    # one tidy_levels, one set of bracketing levels and one set of far levels, while the PCHIP fits and evaluations
+    # for every profile and variable are made together, in a handful of array operations.
+    # returns dicts mapping each variable name to an (nprof, nlevel) array of interpolated values, nan where masked,
+    # as for ProfileCollection.on_levels or build_dataset, and to an (nprof,) array of the flags interpolate_to_levels would give.
+    # profiles left with fewer than two levels to interpolate from are all nan, flagged 32.
+
+    levels = numpy.asarray(levels, dtype=float)
+    values = {name: numpy.full((len(pressures), len(levels)), numpy.nan) for name in variables}
+    curves = PchipCurves(pressures, variables)
+    if len(curves) == 0:
+        return values, curves.flags
+
+    k, far = curves.bracket(levels)
+    s = levels[None, :] - curves.x[k]
+    for j, name in enumerate(curves.names):
+        on = curves.on[:, j]
+        interp = curves.evaluate(k[on], s[on], j)
+        interp[far[on]] = numpy.nan
+        values[name][curves.owner[on]] = interp
+
+    return values, curves.flags
+
+def MLD_profiles(pressures, variables, threshold_delta, reference_pressure=10, workers=1, chunk_size=1000):
+    # MLD_estimate for many profiles at once: <pressures> and <variables> are lists of each profile's pressure and variable vectors,
+    # like potential density. each profile is tidied and fit once, for both the value at the reference pressure and the threshold crossing,
+    # and every profile's crossing is found together. returns (nprof,) arrays of mixed layer depths, nan where MLD_estimate gives None,
+    # and of the flags it gives; profiles left with a single level are flagged 32 rather than raising.
+    # with <workers> other than 1, profiles are spread over that many processes, <chunk_size> at a time, as in interpolate_parallel.
+
+    if workers != 1:
+        results = map_chunks(MLD_profiles, [pressures, variables], [threshold_delta, reference_pressure], workers=workers, chunk_size=chunk_size)
+        return numpy.concatenate([r[0] for r in results]), numpy.concatenate([r[1] for r in results])
+
+    mld = numpy.full(len(pressures), numpy.nan)
+    curves = PchipCurves(pressures, {'var': variables})
+    flags = curves.flags['var']
+    if len(curves) == 0:
+        return mld, flags
+
+    ## value at the reference pressure, as interpolate_to_levels finds it
+    k, far = curves.bracket([reference_pressure])
+    reference = curves.evaluate(k[:, 0], reference_pressure - curves.x[k[:, 0]], 0)
+    ok = ~far[:, 0] & numpy.isfinite(reference)
+
+    ## every interval between measured levels, on curves with a reference value, relative to its curve's threshold
+    last = numpy.zeros(len(curves.x), dtype=bool)
+    last[curves.start + curves.count - 1] = True
+    i = numpy.flatnonzero(~last)
+    c = numpy.repeat(numpy.arange(len(curves)), curves.count - 1) # curve each interval is on
+    i, c = i[ok[c]], c[ok[c]]
+    # measured values within rounding error of the threshold, like 1025.05 against 1025.02 + 0.03, count as on it
+    threshold = reference[c] + threshold_delta
+    tolerance = 4 * numpy.finfo(float).eps * numpy.abs(threshold)
+    c0, c1, c2, c3 = curves.coefficients(i, 0)
+    c3 = c3 - threshold
+    c3[numpy.abs(c3) <= tolerance] = 0
+    end = curves.y[i+1, 0] - threshold
+    end[numpy.abs(end) <= tolerance] = 0
+    h = curves.x[i+1] - curves.x[i]
+
+    ## PCHIP is monotonic between measured levels, so each interval crosses the threshold at most once, unless it's flat on it
+    flat = (c0 == 0) & (c1 == 0) & (c2 == 0) & (c3 == 0)
+    crossing = (numpy.sign(c3) * numpy.sign(end) <= 0) & ~flat
+    offset = numpy.where(c3 == 0, 0, h)
+
+    ## bisect the crossings strictly inside their intervals down to machine precision, all at once
+    inner = crossing & (c3 != 0) & (end != 0)
+    a0, a1, a2, a3 = c0[inner], c1[inner], c2[inner], c3[inner]
+    rising = end[inner] > a3
+    lo, hi = numpy.zeros(inner.sum()), h[inner]
+    for n in range(64):
+        mid = (lo + hi) / 2
+        past = (a3 + a2*mid + a1*(mid*mid) + a0*(mid*mid*mid) > 0) == rising
+        lo, hi = numpy.where(past, lo, mid), numpy.where(past, mid, hi)
+    offset[inner] = hi
+    root = curves.x[i] + offset
+
+    ## the first root past the reference pressure; as in MLD_estimate, no roots at all, none past the reference pressure,
+    ## or a first one that's a whole flat stretch are flagged 512
+    first = numpy.full(len(curves), len(i))
+    numpy.minimum.at(first, c[crossing | flat], numpy.flatnonzero(crossing | flat))
+    depth = numpy.full(len(curves), numpy.inf)
+    valid = crossing & (root > reference_pressure)
+    numpy.minimum.at(depth, c[valid], root[valid])
+    found = ok & (first < len(i)) & numpy.isfinite(depth)
+    found[found] = ~flat[first[found]]
+
+    mld[curves.owner[found]] = depth[found]
+    flags[curves.owner[~found]] = 512
+    return mld, flags
+
+def nan_invalid(x):
+    # <x> as an array of floats, nan wherever it isn't numeric, masked elements included
+    values, valid = numeric_values(x)
+    values[~valid] = numpy.nan
+    return values
+
+def pack_vectors(vectors):
+    # a list of <vectors>, None where missing, as one flat float array (nan where not numeric), an array of offsets into it
+    # and a boolean array of which were present, so they can be handed to another process in a few compact arrays
+    present = numpy.array([v is not None for v in vectors], dtype=bool)
+    vals = [nan_invalid(v) if v is not None else numpy.empty(0) for v in vectors]
+    offsets = numpy.concatenate([[0], numpy.cumsum([len(v) for v in vals], dtype=numpy.int64)])
+    return numpy.concatenate(vals) if len(vals) > 0 else numpy.empty(0), offsets, present
+
+def unpack_vectors(flat, offsets, present):
+    # the list of vectors packed by pack_vectors, as views on <flat>
+    return [flat[offsets[i]:offsets[i+1]] if present[i] else None for i in range(len(present))]
+
+def run_packed(function, packed, args):
+    # function(*vectors, *args) in a worker process, where <packed> are lists of vectors or dicts of them, packed by pack_vectors
+    vectors = [{name: unpack_vectors(*v) for name, v in p.items()} if isinstance(p, dict) else unpack_vectors(*p) for p in packed]
+    return function(*vectors, *args)
+
+def map_chunks(function, vectors, args, workers=None, chunk_size=1000):
+    # function(*vectors, *args) spread over a pool of <workers> processes, one per CPU if None, <chunk_size> profiles at a time,
+    # where <vectors> are lists of each profile's vectors, or dicts of them; each chunk is sent to its worker packed into flat arrays.
+    # returns the list of results for each chunk, in order.
+
+    workers = workers or os.cpu_count()
+    n = len(vectors[0])
+    results = []
+    with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as pool:
+        pending = collections.deque()
+        for a in range(0, max(n, 1), chunk_size):
+            # keep a couple of chunks per worker queued, without packing every chunk up front
+            if len(pending) >= 2*workers:
+                results.append(pending.popleft().result())
+            packed = [{name: pack_vectors(vecs[a:a+chunk_size]) for name, vecs in v.items()} if isinstance(v, dict) else pack_vectors(v[a:a+chunk_size]) for v in vectors]
+            pending.append(pool.submit(run_packed, function, packed, args))
+        results += [f.result() for f in pending]
+    return results
+
+def interpolate_parallel(pressures, variables, levels, workers=None, chunk_size=1000):
+    # interpolate_profiles spread over a pool of <workers> processes, one per CPU if None, <chunk_size> profiles at a time;
+    # each chunk is sent to its worker packed into flat arrays, and the results are put back together in order.
+    # takes and returns the same things as interpolate_profiles.
+
+    results = map_chunks(interpolate_profiles, [pressures, variables], [levels], workers=workers, chunk_size=chunk_size)
+    values = {name: numpy.concatenate([r[0][name] for r in results]) for name in variables}
+    flags = {name: numpy.concatenate([r[1][name] for r in results]) for name in variables}
+    return values, flags
+
+def interpolate_all(profile, levels, workers=1, chunk_size=1000):
     # interpolate all variables in a profile to a common set of levels
-    # profile is either a json profile schema or a Profile object.
+    # profile is either a json profile schema, a Profile object, or a ProfileCollection, which is interpolated all at once (see interpolate_profiles)
+    # to a new ProfileCollection; a collection can also be spread over <workers> processes, <chunk_size> profiles at a time (see interpolate_parallel).
     # assumes json profile has its 'data_info' key present and that 'pressure' is one of the variables, to be interpolated on.
     
-    if isinstance(profile, Profile):
+    if isinstance(profile, ProfileCollection):
+        datavecs = [x for x in profile.variable_names() if 'qc' not in x and x != 'pressure']
+        pressures = [profile.getvar('pressure', i) for i in range(len(profile))]
+        variables = {v: [profile.getvar(v, i) if profile.hasvar(v, i) else None for i in range(len(profile))] for v in datavecs}
+        if workers == 1:
+            values, _ = interpolate_profiles(pressures, variables, levels)
+        else:
+            values, _ = interpolate_parallel(pressures, variables, levels, workers=workers, chunk_size=chunk_size)
+        return profile.on_levels(levels, values)
+    elif isinstance(profile, Profile):
         variables = profile.variable_names()
         datavecs = [x for x in variables if 'qc' not in x] # don't interpolate QC; a bit duck-typie...
         pressure = profile.getvar('pressure')
@@ -0,0 +1,171 @@
+# persistent on-disk caches of Argovis API responses and metadata documents, so repeated analyses don't go back to the network;
+# hand a ResponseCache to helpers.Client(cache=...) and every argofetch made through that client will use it,
+# and a MetadataStore to helpers.Client(metadata=...) to keep the metadata documents query_metadata looks up.
+
+import sqlite3, zlib, json, hashlib, time, threading, os
+
+class ResponseCache:
+    # responses are stored zlib-compressed in a SQLite database in <directory>, keyed on a hash of (apiroot, route, options).
+    # <ttl> maps routes or route prefixes, like 'argo' or 'grids', to how many seconds their responses stay fresh;
+    # anything not listed there keeps for <default_ttl> seconds.
+    # once the stored responses add up to more than <max_bytes>, the least recently used are evicted.
+
+    def __init__(self, directory='~/.cache/argovisHelpers', max_bytes=2*1024**3, default_ttl=86400, ttl={}):
+        self.directory = os.path.expanduser(directory)
+        self.max_bytes = max_bytes
+        self.default_ttl = default_ttl
+        self.ttl = {k.strip('/'): v for k, v in ttl.items()}
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+
+        os.makedirs(self.directory, exist_ok=True)
+        self._db = sqlite3.connect(os.path.join(self.directory, 'responses.sqlite'), timeout=30, check_same_thread=False)
+        with self._db:
+            self._db.execute('CREATE TABLE IF NOT EXISTS responses (key TEXT PRIMARY KEY, route TEXT, expires REAL, accessed REAL, size INTEGER, body BLOB)')
+            self._db.execute('CREATE INDEX IF NOT EXISTS responses_accessed ON responses (accessed)')
+
+    # ---- keys and lifetimes ----
+    @staticmethod
+    def key(apiroot, route, options):
+        # options are normalized the way they go over the wire, so equivalent requests share a key
+        route = route.strip('/')
+        params = sorted((k, str(v)) for k, v in options.items())
+        return hashlib.sha256(json.dumps([apiroot.rstrip('/'), route, params]).encode()).hexdigest()
+
+    def route_ttl(self, route):
+        # the most specific entry in self.ttl for <route>, or default_ttl
+        tokens = route.strip('/').split('/')
+        for i in range(len(tokens), 0, -1):
+            prefix = '/'.join(tokens[:i])
+            if prefix in self.ttl:
+                return self.ttl[prefix]
+        return self.default_ttl
+
+    # ---- reading and writing ----
+    def get(self, apiroot, route, options):
+        # the cached response for this request, or None if there isn't a fresh one
+        key = self.key(apiroot, route, options)
+        now = time.time()
+        with self._lock, self._db:
+            row = self._db.execute('SELECT expires, body FROM responses WHERE key = ?', (key,)).fetchone()
+            if row is None or row[0] < now:
+                if row is not None:
+                    self._db.execute('DELETE FROM responses WHERE key = ?', (key,))
+                self.misses += 1
+                return None
+            self._db.execute('UPDATE responses SET accessed = ? WHERE key = ?', (now, key))
+            self.hits += 1
+        return json.loads(zlib.decompress(row[1]))
+
+    def put(self, apiroot, route, options, response):
+        # store <response> for this request, then evict least recently used responses until under max_bytes
+        key = self.key(apiroot, route, options)
+        body = zlib.compress(json.dumps(response).encode())
+        now = time.time()
+        with self._lock, self._db:
+            self._db.execute('INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?, ?, ?)', (key, route.strip('/'), now + self.route_ttl(route), now, len(body), body))
+            self._evict()
+
+    def _evict(self):
+        total = self._db.execute('SELECT COALESCE(SUM(size), 0) FROM responses').fetchone()[0]
+        if total <= self.max_bytes:
+            return
+        for key, size in self._db.execute('SELECT key, size FROM responses ORDER BY accessed').fetchall():
+            self._db.execute('DELETE FROM responses WHERE key = ?', (key,))
+            total -= size
+            if total <= self.max_bytes:
+                break
+
+    # ---- housekeeping ----
+    def expire(self):
+        # drop every response that has gone stale
+        with self._lock, self._db:
+            self._db.execute('DELETE FROM responses WHERE expires < ?', (time.time(),))
+
+    def clear(self):
+        with self._lock, self._db:
+            self._db.execute('DELETE FROM responses')
+        self.hits = 0
+        self.misses = 0
+
+    def stats(self):
+        # hit and miss counts for this process, and the number and compressed size of stored responses
+        with self._lock:
+            entries, size = self._db.execute('SELECT COUNT(*), COALESCE(SUM(size), 0) FROM responses').fetchone()
+        return {'hits': self.hits, 'misses': self.misses, 'entries': entries, 'bytes': size}
+
+    def close(self):
+        self._db.close()
+
+class MetadataStore:
+    # persistent store of metadata documents, like argo float or cchdo cruise metadata, keyed on (apiroot, metadata route, _id),
+    # so that searches in later processes needing the same metadata don't fetch it again;
+    # hand one to helpers.Client(metadata=...) and query_metadata, queryProfile and queryGrid through that client will use it.
+    # documents stay fresh for <ttl> seconds, and once there are more than <max_entries>, the least recently used are evicted.
+
+    def __init__(self, directory='~/.cache/argovisHelpers', max_entries=100000, ttl=7*86400):
+        self.directory = os.path.expanduser(directory)
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+
+        os.makedirs(self.directory, exist_ok=True)
+        self._db = sqlite3.connect(os.path.join(self.directory, 'metadata.sqlite'), timeout=30, check_same_thread=False)
+        with self._db:
+            self._db.execute('CREATE TABLE IF NOT EXISTS metadata (apiroot TEXT, route TEXT, id TEXT, expires REAL, accessed REAL, body BLOB, PRIMARY KEY (apiroot, route, id))')
+            self._db.execute('CREATE INDEX IF NOT EXISTS metadata_accessed ON metadata (accessed)')
+
+    # ---- reading and writing ----
+    def get(self, apiroot, route, ids):
+        # dict of the fresh metadata documents among <ids> from <route>, by _id
+        apiroot, route = apiroot.rstrip('/'), route.strip('/')
+        now = time.time()
+        found = {}
+        with self._lock, self._db:
+            for id in ids:
+                row = self._db.execute('SELECT expires, body FROM metadata WHERE apiroot = ? AND route = ? AND id = ?', (apiroot, route, id)).fetchone()
+                if row is None or row[0] < now:
+                    self.misses += 1
+                    continue
+                found[id] = row[1]
+            self._db.executemany('UPDATE metadata SET accessed = ? WHERE apiroot = ? AND route = ? AND id = ?', [(now, apiroot, route, id) for id in found])
+            self.hits += len(found)
+        return {id: json.loads(zlib.decompress(body)) for id, body in found.items()}
+
+    def put(self, apiroot, route, docs):
+        # store the metadata documents <docs> from <route>, then evict least recently used documents until under max_entries
+        apiroot, route = apiroot.rstrip('/'), route.strip('/')
+        now = time.time()
+        rows = [(apiroot, route, str(m['_id']), now + self.ttl, now, zlib.compress(json.dumps(m).encode())) for m in docs]
+        with self._lock, self._db:
+            self._db.executemany('INSERT OR REPLACE INTO metadata VALUES (?, ?, ?, ?, ?, ?)', rows)
+            self._evict()
+
+    def _evict(self):
+        excess = self._db.execute('SELECT COUNT(*) FROM metadata').fetchone()[0] - self.max_entries
+        if excess > 0:
+            self._db.execute('DELETE FROM metadata WHERE rowid IN (SELECT rowid FROM metadata ORDER BY accessed LIMIT ?)', (excess,))
+
+    # ---- housekeeping ----
+    def expire(self):
+        # drop every document that has gone stale
+        with self._lock, self._db:
+            self._db.execute('DELETE FROM metadata WHERE expires < ?', (time.time(),))
+
+    def clear(self):
+        with self._lock, self._db:
+            self._db.execute('DELETE FROM metadata')
+        self.hits = 0
+        self.misses = 0
+
+    def stats(self):
+        # hit and miss counts for this process, and the number of stored documents
+        with self._lock:
+            entries = self._db.execute('SELECT COUNT(*) FROM metadata').fetchone()[0]
+        return {'hits': self.hits, 'misses': self.misses, 'entries': entries}
+
+    def close(self):
+        self._db.close()
@@ -1,5 +1,7 @@
 from __future__ import annotations
-import requests, datetime, copy, time, re, area, math, urllib, json, xarray, numpy, scipy.interpolate, gsw
+import requests, datetime, copy, time, re, area, math, urllib, json, xarray, numpy, scipy.interpolate, gsw, threading, itertools, random
+import concurrent.futures, functools, collections, requests.adapters, os
+import geopandas as gpd
 from shapely.geometry import shape, box, Polygon
 from shapely.ops import orient
 from importlib.metadata import version, PackageNotFoundError
@@ -7,36 +9,128 @@ from dataclasses import dataclass, field
 from typing import Any
 from dateutil import parser
 from collections.abc import Sequence
+try:
+    import orjson # optional, decodes JSON several times faster than the standard library
+except ImportError:
+    orjson = None
+
+class TTLCache:
+    # bounded, thread-safe in-memory cache; entries expire <ttl> seconds after they're stored,
+    # and the least recently used are evicted once there are more than <maxsize> of them.
+    # get_or_fetch also de-duplicates concurrent misses on the same key: one caller fetches while the rest wait for its result.
+
+    def __init__(self, maxsize=128, ttl=3600):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._entries = collections.OrderedDict() # key: (time stored, value), least recently used first
+        self._inflight = {} # key: threading.Event set when the fetch for key finishes
+        self._lock = threading.Lock()
+
+    def _lookup(self, key, now):
+        # return (True, value) for a fresh entry and mark it recently used, (False, None) otherwise; call with lock held
+        if key in self._entries:
+            stored, value = self._entries[key]
+            if now - stored < self.ttl:
+                self._entries.move_to_end(key)
+                return True, value
+            del self._entries[key]
+        return False, None
+
+    def get(self, key, default=None):
+        with self._lock:
+            found, value = self._lookup(key, time.time())
+            if found:
+                self.hits += 1
+                return value
+            self.misses += 1
+            return default
+
+    def put(self, key, value):
+        self.put_many([(key, value)])
+
+    def put_many(self, items):
+        # store every (key, value) pair in <items> under a single acquisition of the lock.
+        # expired entries are only dropped from the least recently used end, so each put does bounded work;
+        # any others are dropped when they're looked up, or evicted once they reach that end.
+        with self._lock:
+            now = time.time()
+            for key, value in items:
+                self._entries[key] = (now, value)
+                self._entries.move_to_end(key)
+            while self._entries and now - next(iter(self._entries.values()))[0] >= self.ttl:
+                self._entries.popitem(last=False)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def get_or_fetch(self, key, fetch):
+        # the cached value for key if it's fresh, otherwise the result of fetch(), which is cached.
+        while True:
+            with self._lock:
+                found, value = self._lookup(key, time.time())
+                if found:
+                    self.hits += 1
+                    return value
+                leader = key not in self._inflight
+                if leader:
+                    self.misses += 1
+                    self._inflight[key] = threading.Event()
+                done = self._inflight[key]
+            if leader:
+                try:
+                    value = fetch()
+                    self.put(key, value)
+                    return value
+                finally:
+                    with self._lock:
+                        del self._inflight[key]
+                    done.set()
+            # someone else is fetching this key; wait for them and look again
+            # (if their fetch failed, this caller becomes the one to retry it)
+            done.wait()
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.hits = 0
+            self.misses = 0
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {'size': len(self._entries), 'maxsize': self.maxsize, 'hits': self.hits, 'misses': self.misses, 'hit_rate': self.hits / lookups if lookups else 0}
 
-_avhcache = {}
 _CACHE_EXPIRY = 3600
+_avhcache = TTLCache(maxsize=128, ttl=_CACHE_EXPIRY)
+_metacache = TTLCache(maxsize=10000, ttl=_CACHE_EXPIRY) # metadata documents by (apiroot, metadata route, _id)
 
 def fetch_json(endpoint):
     """
     Fetches a JSON document from the given endpoint.
-    Returns a cached version if the last fetch was within the last hour.
+    Returns a cached version if the last fetch was within the last hour;
+    concurrent calls for the same endpoint share a single fetch.
     """
-    global _avhcache
-
-    current_time = time.time()
-
-    # Check if we have a cached version and if it's still valid
-    if endpoint in _avhcache:
-        cached_time, cached_data = _avhcache[endpoint]
-        if current_time - cached_time < _CACHE_EXPIRY:
-            return cached_data  # Return cached data
 
-    # Fetch the data from the API
-    try:
-        response = requests.get(endpoint)
-        response.raise_for_status()  # Raise an exception for HTTP errors
-        json_data = response.json()
-
-        # Cache the result with the current timestamp
-        _avhcache[endpoint] = (current_time, json_data)
-        return json_data
-    except requests.RequestException as e:
-        raise RuntimeError(f"Failed to fetch data from {endpoint}: {e}")
+    def fetch():
+        # Fetch the data from the API, retrying failed connections as the default client's RetryPolicy allows
+        client = default_client()
+        attempt = 0
+        while True:
+            try:
+                response = client.get(endpoint)
+                response.raise_for_status()  # Raise an exception for HTTP errors
+                return response.json()
+            except (requests.exceptions.ConnectionError, requests.exceptions.Timeout) as e:
+                wait = client.retry.wait(attempt)
+                if wait is None:
+                    raise RuntimeError(f"Failed to fetch data from {endpoint}: {e}")
+                time.sleep(wait)
+                attempt += 1
+            except requests.RequestException as e:
+                raise RuntimeError(f"Failed to fetch data from {endpoint}: {e}")
+
+    return _avhcache.get_or_fetch(endpoint, fetch)
 
 def get_timebound(dataset, bound):
     core_rl = fetch_json("https://argovis-api.colorado.edu/summary?id=ratelimiter")
@@ -63,23 +157,22 @@ def get_timebound(dataset, bound):
     return parsetime(rl[keymap[dataset]][bound])
 
 
-def slice_timesteps(options, r):
-    # given a qsr option dict and data route, return a list of reasonable time divisions
+def search_extent(options):
+    # area covered by the polygon or box in a qsr option dict, in units of 13000 sq. km. blocks; all the oceans if neither is present
 
-    maxbulk = 2000000 # should be <= maxbulk used in generating an API 413
-    timestep = 30 # days
     extent = 360000000 / 13000 #// 360M sq km, all the oceans
     
     if 'polygon' in options:
         extent = area.area({'type':'Polygon','coordinates':[ options['polygon'] ]}) / 13000 / 1000000 # poly area in units of 13000 sq. km. blocks
     elif 'box' in options:
-        extent = area.area({'type':'Polygon','coordinates':[[ options['box'][0], [options['box'][1][0], options['box'][0][0]], options['box'][1], [options['box'][0][0], options['box'][1][0]], options['box'][0]]]}) / 13000 / 1000000
-        
-    timestep = min(365*100,math.floor(maxbulk / extent))
+        b = options['box']
+        extent = area.area({'type':'Polygon','coordinates':[[ b[0], [b[1][0], b[0][1]], b[1], [b[0][0], b[1][1]], b[0] ]]}) / 13000 / 1000000
+
+    return extent
+
+def search_timespan(options, r):
+    # start and end datetimes of a qsr option dict on data route <r>, falling back to the bounds of the dataset
 
-    ## slice up in time bins:
-    start = None
-    end = None
     if 'startDate' in options:
         start = parsetime(options['startDate'])
     else:
@@ -88,16 +181,108 @@ def slice_timesteps(options, r):
         end = parsetime(options['endDate'])
     else:
         end = get_timebound(r, 'endDate')
+
+    return start, end
+
+def search_bulk(options, r):
+    # size of a search as the API judges it for a 413: area in 13000 sq. km. blocks times duration in days
+    start, end = search_timespan(options, r)
+    return search_extent(options) * max((end - start).total_seconds() / 86400, 1)
+
+def slice_timesteps(options, r, maxbulk=2000000):
+    # given a qsr option dict and data route, return a list of reasonable time divisions
+    # maxbulk should be <= maxbulk used in generating an API 413
+
+    extent = search_extent(options)
+    timestep = max(1, min(365*100,math.floor(maxbulk / extent))) # days
+
+    ## slice up in time bins:
+    start, end = search_timespan(options, r)
         
-    delta = datetime.datetime.timedelta(days=timestep)
-    times = [start]
-    while times[-1] + delta < end:
-        times.append(times[-1]+delta)
-    times.append(end)
-    times = [parsetime(x) for x in times]
-    
-    return times
-    
+    start, end = numpy.datetime64(start, 'us'), numpy.datetime64(end, 'us')
+    delta = numpy.timedelta64(timestep, 'D')
+    times = numpy.concatenate(([start], numpy.arange(start + delta, end, delta), [end]))
+
+    return parsetimes(times).tolist()
+
+class SliceSizer:
+    # learns, per API root and route, how big a slice of a query can be: how many documents come back per unit of bulk (see search_bulk),
+    # and the most bulk the API will accept before answering 413.
+    # slice_plan uses what it has learned to make as few requests as possible, aiming for about <target_docs> documents per slice,
+    # while slices the API still rejects are split up further as they're fetched.
+    # each new slice counts for more than the ones before it, which are discounted by <memory>, so the density follows the searches
+    # being made, and each slice the API accepts lets the bulk it's expected to accept grow back by <growth>, up to <maxbulk>.
+
+    def __init__(self, maxbulk=2000000, target_docs=10000, memory=0.8, growth=1.1):
+        self.maxbulk = maxbulk
+        self.target_docs = target_docs
+        self.memory = memory
+        self.growth = growth
+        self._routes = {} # (apiroot, route): {'docs': documents seen, 'bulk': bulk they came from, 'maxbulk': most bulk the API is expected to accept}
+        self._lock = threading.Lock()
+
+    def _key(self, route, apiroot):
+        return (apiroot.rstrip('/'), route.strip('/'))
+
+    def _route(self, route, apiroot):
+        return self._routes.setdefault(self._key(route, apiroot), {'docs': 0, 'bulk': 0, 'maxbulk': self.maxbulk})
+
+    def observe(self, route, bulk, ndocs, apiroot='https://argovis-api.colorado.edu/'):
+        # a slice of <bulk> came back with <ndocs> documents
+        with self._lock:
+            r = self._route(route, apiroot)
+            r['docs'] = self.memory*r['docs'] + ndocs
+            r['bulk'] = self.memory*r['bulk'] + bulk
+            r['maxbulk'] = min(self.maxbulk, self.growth*r['maxbulk'])
+
+    def rejected(self, route, bulk, apiroot='https://argovis-api.colorado.edu/'):
+        # the API answered 413 for a slice of <bulk>
+        with self._lock:
+            r = self._route(route, apiroot)
+            r['maxbulk'] = min(r['maxbulk'], 0.9*bulk)
+
+    def limit(self, route, apiroot='https://argovis-api.colorado.edu/'):
+        # the most bulk a slice on <route> should have, or None if nothing has been learned about it yet
+        with self._lock:
+            r = self._routes.get(self._key(route, apiroot))
+            if r is None:
+                return None
+            if r['docs'] == 0:
+                return r['maxbulk']
+            return min(r['maxbulk'], self.target_docs * r['bulk'] / r['docs'])
+
+default_sizer = SliceSizer()
+
+def cell_size(bulk_limit, days):
+    # largest of a few sizes in degrees, that divide the globe evenly, for square cells whose bulk over <days> stays under <bulk_limit> at the equator
+    sizes = [1, 2.5, 5, 10, 15, 30, 45, 90]
+    fits = [x for x in sizes if (x*111.32)**2 / 13000 * max(days, 1) <= bulk_limit]
+    return fits[-1] if len(fits) > 0 else sizes[0]
+
+def split_slice(options, spatial):
+    # cut the option dict for a slice the API rejected with a 413 into smaller pieces: quarters in space if <spatial>, halves in time otherwise
+    if spatial:
+        if 'box' in options:
+            b = options['box']
+            width = (b[1][0] - b[0][0]) % 360 or 360
+            height = b[1][1] - b[0][1]
+            if width < 0.01 or height < 0.01:
+                return None
+            return [{**options, 'box': x} for x in split_box(copy.deepcopy(b), width/2, height/2)]
+        else:
+            coords = options.get('polygon', [[-180,-90],[180,-90],[180,90],[-180,90],[-180,-90]])
+            min_lon, min_lat, max_lon, max_lat = shape({'type': 'Polygon', 'coordinates': [dont_wrap_dateline(coords)]}).bounds
+            if max_lon - min_lon < 0.01 or max_lat - min_lat < 0.01:
+                return None
+            return [{**options, 'polygon': x} for x in split_polygon(coords, (max_lon - min_lon)/2, (max_lat - min_lat)/2)]
+    else:
+        start = parsetime(options['startDate'])
+        end = parsetime(options['endDate'])
+        if end - start < datetime.timedelta(minutes=1):
+            return None
+        middle = parsetime(start + (end - start)/2)
+        return [{**options, 'endDate': middle}, {**options, 'startDate': middle}]
+
 def data_inflate(data_doc, metadata_doc=None):
     # given a single JSON <data_doc> downloaded from one of the standard data routes,
     # return the data document with the data key reinflated to per-level dictionaries.
@@ -141,6 +326,22 @@ def parsetime(time):
     else:
         raise ValueError(time)
 
+def parsetimes(times):
+    # batch parsetime: times can be a list or array of argopy-compliant datestrings, or of datetimes / numpy.datetime64s;
+    # returns the opposite, as a numpy array of datetime64[us] or of datestrings.
+    # Argovis' fixed format is parsed by numpy in one call; anything else falls back to dateutil, one string at a time.
+
+    times = numpy.asarray(times)
+    if times.size == 0 or times.dtype.kind == 'U' or (times.dtype.kind == 'O' and isinstance(times.flat[0], str)):
+        try:
+            return numpy.char.rstrip(times.astype(str), 'Z').astype('datetime64[us]')
+        except ValueError:
+            return numpy.array([parser.parse(t, ignoretz=True) for t in times.flat], dtype='datetime64[us]').reshape(times.shape)
+    elif times.dtype.kind in 'MO':
+        return numpy.array([t + 'Z' for t in numpy.datetime_as_string(times.astype('datetime64[us]'), unit='us').flat]).reshape(times.shape)
+    else:
+        raise ValueError(times)
+
 def units_inflate(data_doc, metadata_doc=None):
     # similar to data_inflate, but for units
 
@@ -241,32 +442,278 @@ def generate_global_cells(lonstep=5, latstep=5):
         lon += lonstep
     return cells
 
-def argofetch(route, options={}, apikey='', apiroot='https://argovis-api.colorado.edu/', suggestedLatency=0, verbose=False):
+@functools.cache
+def telemetry_version():
+    # version string of this package to report in the x-avh-telemetry header; looked up once per process
+
+    try:
+        return version("argovisHelpers")
+    except PackageNotFoundError:
+        return '-1'
+
+def loads(body):
+    # decode the JSON document in bytes or str <body>, with orjson if it's installed; raises ValueError if it isn't JSON
+    if orjson is not None:
+        return orjson.loads(body)
+    return json.loads(body)
+
+class StreamDecoder:
+    # decodes a JSON response body as it arrives: feed() it each chunk of bytes, then collect the document from result().
+    # a top-level array of objects or arrays, like every search result from Argovis, is decoded a run of whole elements at a time,
+    # so only the elements, and not the raw text of the entire body alongside them, ever need to be in memory at once.
+    # element boundaries are found by looking for the separator between two elements, like '},{', and confirmed by decoding
+    # everything up to it as an array, which only succeeds at a real boundary; anything else is decoded once it has all arrived.
+
+    def __init__(self, tries=3):
+        self.tries = tries # candidate boundaries to try per chunk, before waiting for more of the body
+        self.buffer = b''
+        self.elements = None # decoded elements so far, once the body is known to be an array
+        self.separator = None
+
+    def feed(self, chunk):
+        self.buffer += chunk
+        if self.elements is None:
+            body = self.buffer.lstrip()
+            if body[:1] != b'[':
+                return
+            first = body[1:].lstrip()[:1]
+            if first not in (b'{', b'['):
+                return
+            self.elements = []
+            self.separator = b'},{' if first == b'{' else b'],['
+            self.buffer = body[1:]
+
+        cut = len(self.buffer)
+        for i in range(self.tries):
+            cut = self.buffer.rfind(self.separator, 0, cut)
+            if cut < 0:
+                return
+            try:
+                self.elements += loads(b'[' + self.buffer[:cut+1] + b']')
+            except ValueError:
+                continue
+            self.buffer = self.buffer[cut+2:]
+            return
+
+    def result(self):
+        # the decoded document; raises ValueError if the body isn't JSON, like a truncated array or a page of HTML
+        if self.elements is None:
+            return loads(self.buffer)
+        self.elements += loads(b'[' + self.buffer)
+        return self.elements
+
+    def text(self, limit=500):
+        # the first <limit> characters of the body not yet decoded, to report a body that isn't JSON with
+        return self.buffer[:limit].decode('utf-8', errors='replace')
+
+_STREAM_CHUNK = 1 << 20 # bytes of a response body to read at a time
+
+def read_response(response):
+    # a StreamDecoder fed the whole body of the streamed requests.Response <response>, decoding it as it downloads
+
+    decoder = StreamDecoder()
+    for chunk in response.iter_content(chunk_size=_STREAM_CHUNK):
+        decoder.feed(chunk)
+    return decoder
+
+class Client:
+    # pooled, keep-alive HTTP connections to Argovis, shared by every request made through it;
+    # pass one as client=... to argofetch, query, queryGrid or queryProfile, or let them share the default_client().
+    # <pool_size> should be at least the number of workers used to fetch slices concurrently, and <timeout> is (connect, read) seconds per request.
+    # <cache> is an optional cache.ResponseCache consulted before, and filled after, every successful request.
+    # <retry> is the RetryPolicy argofetch follows for server errors, timeouts and failed or dropped connections; it's the only retrying done,
+    # the connection pool itself never retries. if None, it's RetryPolicy(retries=<retries>), or RetryPolicy() if <retries> is None too.
+    # <metadata> is an optional cache.MetadataStore that query_metadata keeps the metadata documents it finds in, across processes.
+
+    def __init__(self, pool_size=10, retries=None, timeout=(10, 300), cache=None, retry=None, metadata=None):
+        self.timeout = timeout
+        self.cache = cache
+        self.metadata = metadata
+        if retry is None:
+            retry = RetryPolicy() if retries is None else RetryPolicy(retries=retries)
+        self.retry = retry
+        self.session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, max_retries=0)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+        self.session.headers['x-avh-telemetry'] = telemetry_version()
+
+    def get(self, url, params=None, apikey=None, timeout=None, stream=False):
+        # <timeout> overrides the client's (connect, read) timeout for this request only;
+        # with <stream>, the body is left to be read from the response as it arrives
+        headers = {} if apikey is None else {'x-argokey': apikey}
+        return self.session.get(url, params=params, headers=headers, timeout=self.timeout if timeout is None else timeout, stream=stream)
+
+    def close(self):
+        self.session.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+class RetryPolicy:
+    # when and for how long to wait before retrying a request that failed in a way that may well not happen again:
+    # an HTTP status in <statuses>, a timeout, or a dropped connection. each request is retried up to <retries> times,
+    # waiting a random time of up to <backoff>*2^n seconds (at most <max_backoff>) before retry n, so concurrent workers don't retry in lockstep.
+    # <budget>, if not None, caps the total number of retries among every request following this policy,
+    # so a sustained outage fails a long job promptly rather than stalling every slice in turn.
+
+    def __init__(self, retries=4, backoff=1, max_backoff=60, budget=None, statuses=(500, 502, 503, 504)):
+        self.retries = retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.budget = budget
+        self.statuses = statuses
+        self._lock = threading.Lock()
+
+    def wait(self, attempt):
+        # seconds to wait before retry number <attempt> (counting from 0) of a failed request, or None if it's out of retries
+        with self._lock:
+            if attempt >= self.retries or (self.budget is not None and self.budget <= 0):
+                return None
+            if self.budget is not None:
+                self.budget -= 1
+        return random.uniform(0, min(self.max_backoff, self.backoff * 2**attempt))
+
+_default_client = None
+_default_client_lock = threading.Lock()
+
+def default_client():
+    # the Client used whenever one isn't passed explicitly, created on first use
+    global _default_client
+
+    with _default_client_lock:
+        if _default_client is None:
+            _default_client = Client()
+        return _default_client
+
+class RateLimiter:
+    # token bucket shared by every request in a sliced query, so that concurrent workers collectively
+    # respect the pacing Argovis asks for: the suggestedLatency from a 429 sets the refill interval,
+    # and the delay from a 429 holds off every worker until it has elapsed.
+
+    def __init__(self, latency=0, burst=1):
+        self.latency = latency
+        self.burst = burst
+        self._tokens = burst
+        self._last = time.monotonic()
+        self._paused_until = 0
+        self._lock = threading.Lock()
+
+    def reserve(self):
+        # try to take a token without blocking;
+        # returns 0 if one was taken, otherwise how many seconds to wait before trying again.
+        with self._lock:
+            now = time.monotonic()
+            if self.latency > 0:
+                self._tokens = min(self.burst, self._tokens + (now - self._last) / self.latency)
+            else:
+                self._tokens = self.burst
+            self._last = now
+            if now < self._paused_until:
+                return self._paused_until - now
+            elif self._tokens >= 1:
+                self._tokens -= 1
+                return 0
+            else:
+                return (1 - self._tokens) * self.latency
+
+    def acquire(self):
+        # block until a request may be issued
+        wait = self.reserve()
+        while wait > 0:
+            time.sleep(wait)
+            wait = self.reserve()
+
+    def throttle(self, delay, latency):
+        # the API rejected a request; nobody goes for <delay> seconds, and requests are paced <latency> seconds apart afterwards
+        with self._lock:
+            self._paused_until = max(self._paused_until, time.monotonic() + delay)
+            self.latency = latency
+            self._tokens = 0
+
+def argofetch(route, options={}, apikey='', apiroot='https://argovis-api.colorado.edu/', suggestedLatency=0, verbose=False, limiter=None, client=None, timeout=None):
     # GET <apiroot>/<route>?<options> with <apikey> in the header.
-    # raises on anything other than success or a 404.
+    # raises on anything other than success or a 404, once <client>'s RetryPolicy gives up on server errors, timeouts and dropped connections.
+    # <limiter> is an optional RateLimiter shared with other concurrent calls;
+    # <client> is the Client whose connections to use, default_client() if None; <timeout> overrides its timeout for this request.
 
     o = copy.deepcopy(options)
     for option in ['polygon', 'box']:
         if option in options:
             options[option] = str(options[option])
 
-    try:
-        vsn = version("argovisHelpers")
-    except PackageNotFoundError:
-        vsn = '-1'
-    dl = requests.get(apiroot.rstrip('/') + '/' + route.lstrip('/'), params = options, headers={'x-argokey': apikey, 'x-avh-telemetry': vsn})
-    statuscode = dl.status_code
-    if verbose:
-        print(urllib.parse.unquote(dl.url))
-    dl = dl.json()
-
-    if statuscode==429:
-        # user exceeded API limit, extract suggested wait and delay times, and try again
-        wait = dl['delay'][0]
-        latency = dl['delay'][1]
-        time.sleep(wait*1.1)
-        return argofetch(route, options=o, apikey=apikey, apiroot=apiroot, suggestedLatency=latency, verbose=verbose)
+    if client is None:
+        client = default_client()
+    if client.cache is not None:
+        cached = client.cache.get(apiroot, route, o)
+        if cached is not None:
+            return cached, suggestedLatency
+
+    url = apiroot.rstrip('/') + '/' + route.lstrip('/')
+    attempt = 0
+    while True:
+        if limiter is not None:
+            limiter.acquire()
+        try:
+            response = client.get(url, params = options, apikey=apikey, timeout=timeout, stream=True)
+            statuscode = response.status_code
+            if verbose:
+                print(urllib.parse.unquote(response.url))
+            decoder = read_response(response)
+        except (requests.exceptions.ConnectionError, requests.exceptions.Timeout, requests.exceptions.ChunkedEncodingError) as e:
+            wait = client.retry.wait(attempt)
+            if wait is None:
+                raise
+            if verbose:
+                print(f'{type(e).__name__} on {urllib.parse.unquote(url)}, retrying in {wait:.1f} s')
+            time.sleep(wait)
+            attempt += 1
+            continue
+
+        try:
+            dl = decoder.result()
+        except ValueError:
+            # not every error comes from the API itself, a proxy in the way might answer with a page of HTML
+            dl = None
+
+        if statuscode==429 and dl is not None:
+            # user exceeded API limit, extract suggested wait and delay times, and try again
+            wait = dl['delay'][0]
+            suggestedLatency = dl['delay'][1]
+            if limiter is not None:
+                limiter.throttle(wait*1.1, suggestedLatency)
+            else:
+                time.sleep(wait*1.1)
+            continue
+
+        if statuscode in client.retry.statuses:
+            wait = client.retry.wait(attempt)
+            if wait is not None:
+                if verbose:
+                    print(f'HTTP {statuscode}, retrying in {wait:.1f} s')
+                time.sleep(wait)
+                attempt += 1
+                continue
+
+        break
+
+    check_status(statuscode, dl, decoder.text())
+    if statuscode == 200 and client.cache is not None:
+        client.cache.put(apiroot, route, o, dl)
+
+    return dl, suggestedLatency
 
+def check_status(statuscode, dl, text=''):
+    # raise on a decoded Argovis response <dl> with HTTP <statuscode> that is anything other than success or a 404.
+    # <dl> is None for a body that isn't JSON, which is always raised on, with <text>, the start of the body, in place of the response.
+
+    if dl is None:
+        if statuscode >= 500:
+            print("Argovis' servers experienced an error. Please try your request again, and email argovis@colorado.edu if this keeps happening; please include the full details of the the request you made so we can help address.")
+        raise Exception(statuscode, text)
     if (statuscode!=404 and statuscode!=200) or (statuscode==200 and type(dl) is dict and 'code' in dl):
         if statuscode == 413:
             print('The temporospatial extent of your request is enormous! If you are using the query helper, it will now try to slice this request up for you. Try setting verbose=true to see how it is slicing this up.')
@@ -276,104 +723,345 @@ def argofetch(route, options={}, apikey='', apiroot='https://argovis-api.colorad
 
     # no special action for 404 - a 404 due to a mangled route will return an error, while a valid search with no result will return [].
 
-    return dl, suggestedLatency
+def slice_plan(route, options, sizer=None, apiroot='https://argovis-api.colorado.edu/'):
+    # decide how to break up a request on <route> with <options> that was too big to make in one go.
+    # returns a list of option dicts, one per sub-request, and True if the slices were made in space
+    # (and so need their results verified against the unsliced search), False if in time.
+    # once <sizer> (default_sizer if None) has learned how dense this route on <apiroot> is, slices are sized to match;
+    # until then, time slices follow the API's bulk limit and space slices are 5x5 degree cells.
 
-def query(route, options={}, apikey='', apiroot='https://argovis-api.colorado.edu/', verbose=False, slice=False):
-    # middleware function between the user and a call to argofetch to make sure individual requests are reasonably scoped and timed.
     r = re.sub('^/', '', route)
     r = re.sub('/$', '', r)
+    if sizer is None:
+        sizer = default_sizer
+    limit = sizer.limit(r, apiroot)
 
-    # start by just trying the request, to determine if we need to slice it
-    if not slice:
-        try:
-            q = argofetch(route, options=copy.deepcopy(options), apikey=apikey, apiroot=apiroot, verbose=verbose)
-            return q[0]
-        except Exception as e:
-            if e.args[0] == 413:
-                # we need to slice
-                return query(route=route, options=copy.deepcopy(options), apikey=apikey, apiroot=apiroot, verbose=verbose, slice=True)
-            else:
-                print(e)
-                return e.args
-        
-    # slice request up into a series of requests
-    
     ## identify timeseries, need to be recombined differently after slicing
     isTimeseries = r.split('/')[0] == 'timeseries'
 
     # should we slice by time or space?
-    times = slice_timesteps(options, r)
-    n_space = 2592 # number of 5x5 bins covering a globe 
+    times = slice_timesteps(options, r) if limit is None else slice_timesteps(options, r, maxbulk=limit)
+    size = 5
+    if limit is not None:
+        size = cell_size(limit, (parsetime(times[-1]) - parsetime(times[0])).total_seconds() / 86400)
+    n_space = (360 // size) * (180 // size) # number of bins covering a globe
     if 'polygon' in options:
-        pgons = split_polygon(options['polygon'])
+        pgons = split_polygon(options['polygon'], size, size)
         n_space = len(pgons)
     elif 'box' in options:
-        boxes = split_box(options['box'])
+        boxes = split_box(copy.deepcopy(options['box']), size, size)
         n_space = len(boxes)
-    
+
     if isTimeseries or n_space < len(times):
         ## slice up in space bins
-        ops = copy.deepcopy(options)
-        results = []
-        delay = 0
-
         if 'box' in options:
-            boxes = split_box(options['box'])
-            for i in range(len(boxes)):
-                ops['box'] = boxes[i]
-                increment = argofetch(route, options=ops, apikey=apikey, apiroot=apiroot, suggestedLatency=delay, verbose=verbose)
-                results += increment[0]
-                delay = increment[1]
-                time.sleep(increment[1]*0.8) # assume the synchronous request is supplying at least some of delay
+            return [{**options, 'box': b} for b in boxes], True
+        elif 'polygon' in options:
+            return [{**options, 'polygon': p} for p in pgons], True
         else:
-            pgons = []
-            if 'polygon' in options:
-                pgons = split_polygon(options['polygon'])
-            else:
-                pgons = generate_global_cells()
-            for i in range(len(pgons)):
-                ops['polygon'] = pgons[i]
-                increment = argofetch(route, options=ops, apikey=apikey, apiroot=apiroot, suggestedLatency=delay, verbose=verbose)
-                results += increment[0]
-                delay = increment[1]
-                time.sleep(increment[1]*0.8) # assume the synchronous request is supplying at least some of delay
-        # smaller polygons will trace geodesics differently than full polygons, need to doublecheck;
-        # do it for boxes too just to make sure nothing funny happened on the boundaries
-        ops = copy.deepcopy(options)
-        ops['compression'] = 'minimal'
-        true_ids = argofetch(route, options=ops, apikey=apikey, apiroot=apiroot, suggestedLatency=delay, verbose=verbose)
-        true_ids = [x[0] for x in true_ids[0]]
-        fetched_ids = [x['_id'] for x in results]
-        if len(fetched_ids) != len(list(set(fetched_ids))):
-            # deduplicate anything scooped up by multiple cells, like on cell borders
-            r = {x['_id']: x for x in results}
-            results = [r[i] for i in list(r.keys())]
-            fetched_ids = [x['_id'] for x in results]
-        to_drop = [item for item in fetched_ids if item not in true_ids]
-        to_add = [item for item in true_ids if item not in fetched_ids]
-        for id in to_add:
-            p, delay = argofetch(route, options={'id': id}, apikey=apikey, apiroot=apiroot, suggestedLatency=delay, verbose=verbose)
-            results += p
-        results = [x for x in results if x['_id'] not in to_drop]
-
+            return [{**options, 'polygon': p} for p in generate_global_cells(size, size)], True
     else:
         ## slice up in time bins
-        results = []
-        ops = copy.deepcopy(options)
-        delay = 0
-        for i in range(len(times)-1):
-            ops['startDate'] = times[i]
-            ops['endDate'] = times[i+1]
-            increment = argofetch(route, options=ops, apikey=apikey, apiroot=apiroot, suggestedLatency=delay, verbose=verbose)
-            results += increment[0]
-            delay = increment[1]
-            time.sleep(increment[1]*0.8) # assume the synchronous request is supplying at least some of delay
+        return [{**options, 'startDate': times[i], 'endDate': times[i+1]} for i in range(len(times)-1)], False
+
+def fetch_slice(route, options, spatial=None, apikey='', apiroot='https://argovis-api.colorado.edu/', verbose=False, limiter=None, client=None, sizer=None):
+    # argofetch one slice from a slice_plan and return its documents.
+    # if the API says the slice is still too big, it's split up (in space if <spatial>, in time otherwise) and the pieces fetched in turn;
+    # either way <sizer> (default_sizer if None) learns from the outcome. <spatial>=None just fetches, no splitting or learning.
+
+    if spatial is None:
+        return argofetch(route, options=copy.deepcopy(options), apikey=apikey, apiroot=apiroot, verbose=verbose, limiter=limiter, client=client)[0]
+
+    if sizer is None:
+        sizer = default_sizer
+    r = route.strip('/')
+    bulk = search_bulk(options, r)
+    try:
+        docs = argofetch(route, options=copy.deepcopy(options), apikey=apikey, apiroot=apiroot, verbose=verbose, limiter=limiter, client=client)[0]
+    except Exception as e:
+        pieces = split_slice(options, spatial) if e.args[0] == 413 else None
+        if pieces is None:
+            raise
+        sizer.rejected(r, bulk, apiroot)
+        if verbose:
+            print(f'slice still too big, splitting into {len(pieces)}')
+        return [x for piece in pieces for x in fetch_slice(route, piece, spatial, apikey=apikey, apiroot=apiroot, verbose=verbose, limiter=limiter, client=client, sizer=sizer)]
+
+    sizer.observe(r, bulk, len(docs), apiroot)
+    return docs
+
+def fetch_slices(route, plan, apikey='', apiroot='https://argovis-api.colorado.edu/', verbose=False, workers=4, limiter=None, client=None, ordered=False, spatial=None, sizer=None):
+    # run fetch_slice for every option dict in <plan> over a pool of <workers> threads, all paced by one RateLimiter.
+    # yields (index in plan, list of documents) for each slice as it completes, in completion order, or in plan order if <ordered>;
+    # only a couple of slices per worker are in flight or waiting their turn at once, so a slow consumer doesn't pile up results.
+    # <spatial> and <sizer> are as for fetch_slice; leave spatial as None for plans that aren't from slice_plan.
+
+    if limiter is None:
+        limiter = RateLimiter()
+    slices = enumerate(plan)
+    pool = concurrent.futures.ThreadPoolExecutor(max_workers=workers)
+    pending = {}
+    waiting = {} # slices that finished ahead of their turn, when ordered
+    next_i = 0
+
+    def submit(n):
+        for i, ops in itertools.islice(slices, n):
+            pending[pool.submit(fetch_slice, route, ops, spatial, apikey=apikey, apiroot=apiroot, verbose=verbose, limiter=limiter, client=client, sizer=sizer)] = i
+
+    try:
+        submit(2*workers)
+        while pending:
+            done, _ = concurrent.futures.wait(pending, return_when=concurrent.futures.FIRST_COMPLETED)
+            for f in done:
+                i = pending.pop(f)
+                if ordered:
+                    waiting[i] = f.result()
+                else:
+                    yield i, f.result()
+            while next_i in waiting:
+                yield next_i, waiting.pop(next_i)
+                next_i += 1
+            submit(2*workers - len(pending) - len(waiting))
+    finally:
+        pool.shutdown(wait=True, cancel_futures=True)
+
+def document_id(doc):
+    # _id of a document, whether it's a full JSON document or a list from a compression=minimal search
+    return doc['_id'] if isinstance(doc, dict) else doc[0]
+
+class SliceJournal:
+    # checkpoint of a sliced query in progress, kept in the file at <path> so an interrupted query can pick up where it left off.
+    # the file is JSON lines: a header with the query and its slice plan, the ids the unsliced search matches if the plan is spatial,
+    # then the documents of each slice as it finishes. a line left half written by a crash is dropped on reopening.
+
+    def __init__(self, path, route, options, apiroot='https://argovis-api.colorado.edu/'):
+        self.path = os.path.expanduser(path)
+        self.query = [apiroot.rstrip('/'), route.strip('/'), sorted([k, str(v)] for k, v in options.items())]
+        self.plan = None
+        self.spatial = None
+        self.true_ids = None
+        self.done = {} # plan index of each finished slice -> offset of its line in the file
+        if os.path.exists(self.path):
+            self._load()
+
+    def _load(self):
+        offset = 0
+        with open(self.path, 'rb') as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    break
+                if 'query' in entry:
+                    if entry['query'] != self.query:
+                        raise Exception(f'checkpoint {self.path} belongs to a different query; delete it or choose another path')
+                    self.plan = entry['plan']
+                    self.spatial = entry['spatial']
+                elif 'true_ids' in entry:
+                    self.true_ids = entry['true_ids']
+                else:
+                    self.done[entry['slice']] = offset
+                offset += len(line)
+        # cut off anything after the last complete line, so new lines aren't appended to a fragment
+        os.truncate(self.path, offset)
+
+    def _append(self, entry):
+        line = json.dumps(entry, default=str).encode() + b'\n'
+        with open(self.path, 'ab') as f:
+            offset = f.tell()
+            f.write(line)
+            f.flush()
+            os.fsync(f.fileno())
+        return offset
+
+    def start(self, plan, spatial):
+        # begin a new journal for a slice <plan>, discarding whatever was at path
+        with open(self.path, 'wb'):
+            pass
+        self.plan, self.spatial, self.true_ids, self.done = plan, spatial, None, {}
+        self._append({'query': self.query, 'plan': plan, 'spatial': spatial})
+
+    def record_true_ids(self, ids):
+        self.true_ids = ids
+        self._append({'true_ids': ids})
+
+    def record(self, i, docs):
+        # the documents from slice <i> of the plan
+        self.done[i] = self._append({'slice': i, 'docs': docs})
+
+    def docs(self, i):
+        # the documents recorded for slice <i>, read back from disk
+        with open(self.path, 'rb') as f:
+            f.seek(self.done[i])
+            return json.loads(f.readline())['docs']
+
+    def remove(self):
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+def sliced_query(route, options={}, apikey='', apiroot='https://argovis-api.colorado.edu/', verbose=False, workers=4, client=None, ordered=False, sizer=None, checkpoint=None, on_plan=None):
+    # generator doing the work of query for a request that has to be sliced up:
+    # yields documents as each slice arrives, in the order slices complete or, if <ordered>, in the order they were planned.
+    # deduplication and, for spatial slices, verification against the unsliced search happen as each slice comes in,
+    # so only the ids seen so far are kept around, not the documents.
+    # with a <checkpoint> path, the plan and every finished slice are journaled there (see SliceJournal), and a rerun of the same query
+    # replays finished slices from the journal and only fetches the rest; the journal is removed once the query completes.
+    # <on_plan>, if given, is called with the slice plan once it's decided.
+
+    journal = None if checkpoint is None else SliceJournal(checkpoint, route, options, apiroot=apiroot)
+    if journal is not None and journal.plan is not None:
+        plan, spatial = journal.plan, journal.spatial
+        if verbose:
+            print(f'resuming from {checkpoint}: {len(journal.done)} of {len(plan)} slices already done')
+    else:
+        plan, spatial = slice_plan(route, options, sizer=sizer, apiroot=apiroot)
+        if journal is not None:
+            journal.start(plan, spatial)
+    if on_plan is not None:
+        on_plan(plan)
+    limiter = RateLimiter()
+    dedupe = spatial or 'batchmeta' in options
+    verify = spatial and 'batchmeta' not in options # batchmeta slices return metadata, not the documents the search matched
+    seen = set()
+
+    true_ids = None
+    if verify:
+        # smaller polygons will trace geodesics differently than full polygons, need to doublecheck;
+        # do it for boxes too just to make sure nothing funny happened on the boundaries.
+        # get the ids the full search matches up front, so each slice can be checked as it arrives.
+        if journal is not None and journal.true_ids is not None:
+            true_ids = journal.true_ids
+        else:
+            ops = copy.deepcopy(options)
+            ops['compression'] = 'minimal'
+            true_ids = [x[0] for x in argofetch(route, options=ops, apikey=apikey, apiroot=apiroot, verbose=verbose, limiter=limiter, client=client)[0]]
+            if journal is not None:
+                journal.record_true_ids(true_ids)
+        matched = set(true_ids)
+
+    for i, increment in journaled_slices(journal, route, plan, apikey=apikey, apiroot=apiroot, verbose=verbose, workers=workers, limiter=limiter, client=client, ordered=ordered, spatial=spatial, sizer=sizer):
+        for doc in increment:
+            if dedupe:
+                # deduplicate anything scooped up by multiple cells, like on cell borders
+                id = document_id(doc)
+                if id in seen or (verify and id not in matched):
+                    continue
+                seen.add(id)
+            yield doc
+
+    if verify:
+        # fetch anything the slices missed, concurrently like the slices themselves
+        missing = [id for id in true_ids if id not in seen]
+        for i, p in fetch_slices(route, missing_plan(options, missing), apikey=apikey, apiroot=apiroot, verbose=verbose, workers=workers, limiter=limiter, client=client, ordered=ordered):
+            yield from p
+
+    if journal is not None:
+        journal.remove()
+
+def journaled_slices(journal, route, plan, ordered=False, **kwargs):
+    # fetch_slices, except that slices already recorded in <journal> are read back from it instead of fetched,
+    # and each newly fetched slice is recorded before it's yielded. with no journal, just fetch_slices.
+
+    if journal is None:
+        yield from fetch_slices(route, plan, ordered=ordered, **kwargs)
+        return
+
+    done = sorted(journal.done)
+    todo = [i for i in range(len(plan)) if i not in journal.done]
+    k = 0
+    if not ordered:
+        for i in done:
+            yield i, journal.docs(i)
+        k = len(done)
+    for j, docs in fetch_slices(route, [plan[i] for i in todo], ordered=ordered, **kwargs):
+        i = todo[j]
+        journal.record(i, docs)
+        while k < len(done) and done[k] < i:
+            yield done[k], journal.docs(done[k])
+            k += 1
+        yield i, docs
+    for i in done[k:]:
+        yield i, journal.docs(i)
+
+def missing_plan(options, ids):
+    # option dicts to fetch each of <ids> individually, keeping everything from <options> that shapes the returned documents,
+    # like data or presRange, but not the spatial and temporal search that missed them.
+    ops = {k: v for k, v in options.items() if k not in ['polygon', 'box', 'startDate', 'endDate']}
+    return [{**ops, 'id': id} for id in ids]
+
+def query(route, options={}, apikey='', apiroot='https://argovis-api.colorado.edu/', verbose=False, slice=False, workers=4, client=None, sizer=None, checkpoint=None):
+    # middleware function between the user and a call to argofetch to make sure individual requests are reasonably scoped and timed.
+    # if the request needs to be sliced, up to <workers> slices are requested concurrently, sized by <sizer> (default_sizer if None).
+    # <checkpoint> is an optional path to journal sliced requests to, so a rerun after a failure resumes where it left off; see sliced_query.
+
+    return search(route, options=options, apikey=apikey, apiroot=apiroot, verbose=verbose, slice=slice, workers=workers, client=client, sizer=sizer, checkpoint=checkpoint)[0]
+
+def search(route, options={}, apikey='', apiroot='https://argovis-api.colorado.edu/', verbose=False, slice=False, workers=4, client=None, sizer=None, checkpoint=None):
+    # query, returning (results, the list of option dicts it was sliced into, or None if it didn't need slicing)
+
+    # start by just trying the request, to determine if we need to slice it;
+    # if there's a checkpoint from an earlier attempt, we already know we do.
+    if not slice and not (checkpoint is not None and os.path.exists(os.path.expanduser(checkpoint))):
+        try:
+            q = argofetch(route, options=copy.deepcopy(options), apikey=apikey, apiroot=apiroot, verbose=verbose, client=client)
+            return q[0], None
+        except Exception as e:
+            if e.args[0] == 413:
+                # we need to slice
+                return search(route=route, options=copy.deepcopy(options), apikey=apikey, apiroot=apiroot, verbose=verbose, slice=True, workers=workers, client=client, sizer=sizer, checkpoint=checkpoint)
+            else:
+                print(e)
+                return e.args, None
         
-    # slicing can end up duplicating results in batchmeta requests, deduplicate
-    if 'batchmeta' in options:
-        results = list({x['_id']: x for x in results}.values())
+    # slice request up into a series of requests, and reassemble in the order they were planned
+    plans = []
+    results = list(sliced_query(route, options, apikey=apikey, apiroot=apiroot, verbose=verbose, workers=workers, client=client, ordered=True, sizer=sizer, checkpoint=checkpoint, on_plan=plans.append))
 
-    return results
+    # remember the reassembled result, so next time the unsliced request is answered straight from the cache
+    if client is None:
+        client = default_client()
+    if client.cache is not None:
+        client.cache.put(apiroot, route, options, results)
+
+    return results, plans[0]
+
+def iter_query(route, options={}, apikey='', apiroot='https://argovis-api.colorado.edu/', verbose=False, workers=4, client=None, sizer=None, checkpoint=None):
+    # streaming version of query: a generator yielding documents as they arrive, so processing can start before a big sliced request finishes
+    # and the whole result never has to be in memory at once. documents come in whatever order slices complete.
+    # unlike query, errors other than the 413 that triggers slicing are raised.
+
+    q = None
+    if checkpoint is None or not os.path.exists(os.path.expanduser(checkpoint)):
+        try:
+            q = argofetch(route, options=copy.deepcopy(options), apikey=apikey, apiroot=apiroot, verbose=verbose, client=client)[0]
+        except Exception as e:
+            if e.args[0] != 413:
+                raise
+
+    if q is None:
+        yield from sliced_query(route, copy.deepcopy(options), apikey=apikey, apiroot=apiroot, verbose=verbose, workers=workers, client=client, sizer=sizer, checkpoint=checkpoint)
+    elif isinstance(q, list):
+        yield from q
+    elif not (isinstance(q, dict) and q.get('code') == 404):
+        # a 404 is a search that found nothing, but anything else that isn't a list of documents is an error
+        raise Exception(q.get('code') if isinstance(q, dict) else None, q)
+
+def reconcile_slices(results, true_ids):
+    # given the documents <results> gathered from spatial slices and the list of <true_ids> the unsliced search matches,
+    # return the results deduplicated and with anything the full search wouldn't have found dropped,
+    # and the list of ids the slices missed, which still need to be fetched.
+    # linear time: membership is checked against hashed indexes of both lists.
+
+    matched = set(true_ids)
+    fetched = {}
+    for x in results:
+        # deduplicate anything scooped up by multiple cells, like on cell borders
+        id = document_id(x)
+        if id in matched and id not in fetched:
+            fetched[id] = x
+    to_add = [id for id in true_ids if id not in fetched]
+
+    return list(fetched.values()), to_add
 
 def sort_and_dedupe(data):
     # given a list <data> that may either be floats or lists of floats, 
@@ -392,13 +1080,155 @@ def sort_and_dedupe(data):
 
     return sorted(out, key=sort_key)
 
-def queryGrid(route, options={}, apikey='', apiroot='https://argovis-api.colorado.edu/', verbose=False):
+def metadata_route(route):
+    # the route serving the metadata documents for data documents from <route>, like argo/meta for argo or grids/meta for grids/rg09
+    return route.strip('/').split('/')[0] + '/meta'
+
+def metadata_ids(data):
+    # the distinct metadata ids the data documents <data> point to, in order of first appearance
+    return list(dict.fromkeys(d['metadata'][0] for d in data))
+
+def cache_metadata(apiroot, route, ids, store=None):
+    # split <ids> into a dict of metadata documents from <route> already in the cache, and a list of the ids that still need fetching;
+    # ids missing from the in-memory cache are looked for in the cache.MetadataStore <store>, if there is one.
+    found = {}
+    todo = []
+    for id in ids:
+        m = _metacache.get((apiroot, metadata_route(route), id))
+        if m is None:
+            todo.append(id)
+        else:
+            found[id] = m
+    if store is not None and len(todo) > 0:
+        stored = store.get(apiroot, metadata_route(route), todo)
+        store_metadata(apiroot, route, found, list(stored.values()))
+        todo = [id for id in todo if id not in stored]
+    return found, todo
+
+def store_metadata(apiroot, route, found, docs, store=None):
+    # add the metadata documents <docs> fetched from <route> to <found> and the cache, and to the cache.MetadataStore <store> if there is one
+    if not isinstance(docs, list):
+        return # a 404 for a bad route, not a search with results
+    for m in docs:
+        found[m['_id']] = m
+    _metacache.put_many([((apiroot, metadata_route(route), m['_id']), m) for m in docs])
+    if store is not None:
+        store.put(apiroot, metadata_route(route), docs)
+
+def query_metadata(route, data, options={}, apikey='', apiroot='https://argovis-api.colorado.edu/', verbose=False, workers=4, client=None, plan=None):
+    # the metadata documents for the data documents <data> found by searching <route> with <options>;
+    # <plan> is the list of option dicts that search was sliced into, as from search, or None if it wasn't sliced.
+    # metadata already cached for _CACHE_EXPIRY seconds, or in <client>'s MetadataStore if it has one, isn't fetched again.
+    # the rest take one batchmeta search if the search wasn't sliced. if it was, they're fetched with a batchmeta search per slice in <plan>,
+    # rather than working out how to slice a batchmeta search all over again, or one by one if there are no more of them than slices;
+    # either way <workers> at a time. what's found is cached, and if any are still missing, it falls back to a batchmeta search.
+
+    if client is None:
+        client = default_client()
+    ids = metadata_ids(data)
+    found, todo = cache_metadata(apiroot, route, ids, client.metadata)
+
+    def fetch(metaroute, metaplan):
+        try:
+            for i, docs in fetch_slices(metaroute, metaplan, apikey=apikey, apiroot=apiroot, verbose=verbose, workers=workers, client=client):
+                store_metadata(apiroot, route, found, docs, client.metadata)
+        except Exception as e:
+            if verbose:
+                print(f'fetching metadata from {metaroute} failed ({e}), falling back to batchmeta')
+
+    if plan is not None and len(todo) > len(plan):
+        # a batchmeta search per slice of the data search
+        fetch(route, [{**p, 'batchmeta': True} for p in plan])
+        todo = [id for id in todo if id not in found]
+    if plan is not None and 0 < len(todo) <= len(plan):
+        # no more ids than slices, or the few the batchmeta slices missed, like documents on their borders: fetch them one by one
+        fetch(metadata_route(route), [{'id': id} for id in todo])
+
+    if any(id not in found for id in ids):
+        meta = query(route, options={**options, 'batchmeta':True}, apikey=apikey, apiroot=apiroot, verbose=verbose, client=client)
+        store_metadata(apiroot, route, found, meta, client.metadata)
+        return meta
+    return [found[id] for id in ids]
+
+def queryGrid(route, options={}, apikey='', apiroot='https://argovis-api.colorado.edu/', verbose=False, client=None, store=None, dtype=float):
     # perform a search exactly as query(...) on a grid or timeseries route,
-    # and munge the results into an xarray.Dataset
+    # and munge the results into an xarray.Dataset, with data stored as <dtype> (see grid_dataset).
+    # with a <store> path, the search is made one time window at a time, and each window written to a Zarr store there as it arrives;
+    # the Dataset returned is read lazily from the store with dask, one chunk per window, so it can be bigger than memory.
+    # <store> needs dask and zarr, which are optional dependencies: pip install argovisHelpers[lazy]
+
+    if store is not None:
+        return stored_grid(route, store, options=options, apikey=apikey, apiroot=apiroot, verbose=verbose, client=client, dtype=dtype)
     
     ## fetch raw data from Argovis
-    griddata = query(route, options=options, apikey=apikey, apiroot=apiroot, verbose=verbose)
-    gridmeta = query(route, options={**options, 'batchmeta':True}, apikey=apikey, apiroot=apiroot, verbose=verbose)
+    griddata, plan = search(route, options=options, apikey=apikey, apiroot=apiroot, verbose=verbose, client=client)
+    gridmeta = query_metadata(route, griddata, options=options, apikey=apikey, apiroot=apiroot, verbose=verbose, client=client, plan=plan)
+
+    return grid_dataset(griddata, gridmeta, options, dtype=dtype)
+
+def lazy_dependencies():
+    # make sure dask and zarr are around for out-of-core datasets, with a hint on how to get them if not
+    try:
+        import dask.array, zarr
+    except ImportError as e:
+        raise ImportError('out-of-core datasets need dask and zarr; install them with pip install argovisHelpers[lazy]') from e
+
+def stored_grid(route, store, options={}, apikey='', apiroot='https://argovis-api.colorado.edu/', verbose=False, client=None, dtype=float):
+    # queryGrid into the Zarr store at <store>: query and grid one time window at a time, writing each to its own group in the store,
+    # so only one window is ever in memory, then open them all lazily and line them up along timestamp.
+    # windows are sized like time slices, to stay under the API's limit on a single request where possible.
+
+    lazy_dependencies()
+    times = slice_timesteps(options, route.strip('/'))
+    groups = []
+    for i in range(len(times)-1):
+        ops = {**options, 'startDate': times[i], 'endDate': times[i+1]}
+        griddata, plan = search(route, options=ops, apikey=apikey, apiroot=apiroot, verbose=verbose, client=client)
+        if len(griddata) == 0:
+            continue
+        gridmeta = query_metadata(route, griddata, options=ops, apikey=apikey, apiroot=apiroot, verbose=verbose, client=client, plan=plan)
+        group = f'window{i:05d}'
+        grid_dataset(griddata, gridmeta, ops, dtype=dtype).to_zarr(store, group=group, mode='w', consolidated=False)
+        groups.append(group)
+        del griddata
+    if len(groups) == 0:
+        raise Exception('no data found for this search')
+
+    # windows may not cover the same locations or levels; outer join fills the gaps with nan
+    windows = [xarray.open_zarr(store, group=g, consolidated=False) for g in groups]
+    # Zarr attributes don't keep the scale_factor's precision, so packed variables would otherwise decode to float64
+    return xarray.concat(windows, dim='timestamp', join='outer', data_vars='all').astype(storage_dtype(dtype))
+
+def storage_dtype(dtype):
+    # the dtype to hold data in memory that's to be stored as <dtype>: integer types are held as float32 until they're packed on writing
+    return numpy.dtype(numpy.float32) if numpy.dtype(dtype).kind in 'iu' else numpy.dtype(dtype)
+
+def pack_dataset(ds, dtype):
+    # if <dtype> is an integer type, set the encoding of every data variable in the xarray.Dataset <ds> so it's written packed into <dtype>:
+    # scale_factor and add_offset stretch each variable's range over the integers, and the smallest integer is the _FillValue for nan.
+    # being float64, they make the data decode to float64 when read back.
+    # returns <ds>, which is otherwise unchanged.
+
+    dtype = numpy.dtype(dtype)
+    if dtype.kind not in 'iu':
+        return ds
+    info = numpy.iinfo(dtype)
+    for v in ds.data_vars:
+        lo, hi = float(ds[v].min()), float(ds[v].max())
+        if numpy.isnan(lo):
+            lo, hi = 0, 0
+        # scaled in float64, so the scale and offset themselves add no rounding; leave an integer of headroom at either end,
+        # so rounding can't take the minimum onto the _FillValue, and never step finer than float32 can tell the values apart
+        scale = max((hi - lo) / (int(info.max) - int(info.min) - 3), float(numpy.spacing(numpy.float32(max(abs(lo), abs(hi)))))) or 1.0
+        ds[v].encoding.update({'dtype': dtype.name, 'scale_factor': numpy.float64(scale), 'add_offset': numpy.float64(lo - (int(info.min) + 2) * scale), '_FillValue': info.min})
+    return ds
+
+def grid_dataset(griddata, gridmeta, options={}, dtype=float):
+    # munge the data documents <griddata> and metadata documents <gridmeta> found by a grid or timeseries search
+    # made with <options> into an xarray.Dataset.
+    # data are held as <dtype>, like float32 to halve memory; an integer type like int16 holds them as float32,
+    # and sets the encoding to write them packed into <dtype> (see pack_dataset).
+
     metalookup = {x['_id']: x for x in gridmeta}
 
     ## is this a grid or a timeseries?
@@ -446,66 +1276,84 @@ def queryGrid(route, options={}, apikey='', apiroot='https://argovis-api.colorad
             timestamps = [m['timeseries'] for m in gridmeta]
         timestamps = list({x for sub in timestamps for x in sub}) # no weird intervals like in levels
         timestamps.sort()
-    timestamps = [parsetime(t) for t in timestamps]
+    timestrings = timestamps
+    timestamps = parsetimes(timestrings)
     variables = [p['data_info'][0] for p in griddata]
     vars = list({x for sub in variables for x in sub})
     vars.sort()
 
     ## construct 4D data array
+    shape = (len(timestamps), len(longitudes), len(latitudes), len(levels))
     darray = {}
     for v in vars:
-        darray[v] = (('timestamp', 'longitude', 'latitude', 'level'), numpy.full((len(timestamps), len(longitudes), len(latitudes), len(levels)), numpy.nan, dtype=float))
-    
+        darray[v] = (('timestamp', 'longitude', 'latitude', 'level'), numpy.full(shape, numpy.nan, dtype=storage_dtype(dtype)))
+    flat = {v: darray[v][1].reshape(-1) for v in vars} # views of the arrays above, written through flat indexes
+
+    ## coordinate value -> index lookups, so each document's values can be placed all at once
+    def level_key(x):
+        return tuple(x) if isinstance(x, list) else x
+    level_index = {}
+    for i, l in enumerate(levels):
+        level_index.setdefault(level_key(l), i)
+    lon_index = {x: i for i, x in enumerate(longitudes)}
+    lat_index = {x: i for i, x in enumerate(latitudes)}
+    time_index = {}
+    for i, t in enumerate(timestamps):
+        time_index.setdefault(t, i)
+    parsed = {s: time_index[t] for s, t in zip(timestrings, timestamps)} # timestamp string -> index
+    level_idx = {} # level list -> array of level indexes
+
+    def time_idx(t):
+        if t not in parsed:
+            parsed[t] = time_index[parsetimes([t])[0]]
+        return parsed[t]
+
     for p in griddata:
         m = metalookup[p['metadata'][0]]
-        lvls = []
-        if isGrid:
-            if 'levels' in p:
-                lvls = p['levels']
-            else:
-                lvls = m['levels']
+        lon_idx = lon_index[p['geolocation']['coordinates'][0]]
+        lat_idx = lat_index[p['geolocation']['coordinates'][1]]
 
-        times = []
-        if isTS:
-            if 'timeseries' in p:
-                times = p['timeseries']
-            else:
-                times = m['timeseries']
-        times = [parsetime(t) for t in times]
-        
-        lon_idx = longitudes.index(p['geolocation']['coordinates'][0])
-        lat_idx = latitudes.index(p['geolocation']['coordinates'][1])
+        # flat index of every cell this document's data vectors fill, in order
         if isGrid:
-            time_idx = timestamps.index(parsetime(p['timestamp']))
-    
-        for v in vars:
-            if v in p['data_info'][0]:
-                v_idx = p['data_info'][0].index(v)
-                for i,val in enumerate(p['data'][v_idx]):
-                    if isGrid:
-                        lvl_idx = levels.index(lvls[i])
-                    elif isTS:
-                        time_idx = timestamps.index(times[i])
-                        level = 0
-                        if 'level' in p:
-                            level = p['level']
-                        lvl_idx = levels.index(level)
-                    darray[v][1][time_idx][lon_idx][lat_idx][lvl_idx] = val
-                    
+            # documents overwhelmingly share the same few level lists, so look each one up only once
+            lvls = p['levels'] if 'levels' in p else m['levels']
+            k = str(lvls) if 'levels' in p else m['_id']
+            if k not in level_idx:
+                level_idx[k] = numpy.array([level_index[level_key(l)] for l in lvls], dtype=int)
+            lvl_idx = level_idx[k]
+            cells = numpy.ravel_multi_index((time_idx(p['timestamp']), lon_idx, lat_idx, lvl_idx), shape)
+        elif isTS:
+            times = p['timeseries'] if 'timeseries' in p else m['timeseries']
+            t_idx = numpy.array([time_idx(t) for t in times], dtype=int)
+            cells = numpy.ravel_multi_index((t_idx, lon_idx, lat_idx, level_index[p.get('level', 0)]), shape)
+
+        for v_idx, v in enumerate(p['data_info'][0]):
+            vals = numpy.array(p['data'][v_idx], dtype=float)
+            flat[v][cells[:len(vals)]] = vals
+
     if isinstance(levels[0], list): # integral ranges have weird levels, label them with strings
         levels = ['_'.join([str(i) for i in x]) for x in levels]
-    return xarray.Dataset(darray,coords = {'timestamp':timestamps, 'longitude':longitudes, 'latitude':latitudes, 'level':levels})
+    return pack_dataset(xarray.Dataset(darray,coords = {'timestamp':timestamps, 'longitude':longitudes, 'latitude':latitudes, 'level':levels}), dtype)
 
-def queryProfile(route, options={}, apikey='', apiroot='https://argovis-api.colorado.edu/', verbose=False):
+def queryProfile(route, options={}, apikey='', apiroot='https://argovis-api.colorado.edu/', verbose=False, client=None, collection=False):
     # perform a search exactly as query(...) on a profile schema route,
-    # and munge the results into a list of Profile objects
+    # and munge the results into a list of Profile objects, or a ProfileCollection if <collection>
 
     ## fetch raw data from Argovis
-    data = query(route, options=options, apikey=apikey, apiroot=apiroot, verbose=verbose)
-    meta = query(route, options={**options, 'batchmeta':True}, apikey=apikey, apiroot=apiroot, verbose=verbose)
+    data, plan = search(route, options=options, apikey=apikey, apiroot=apiroot, verbose=verbose, client=client)
+    meta = query_metadata(route, data, options=options, apikey=apikey, apiroot=apiroot, verbose=verbose, client=client, plan=plan)
+
+    if collection:
+        return ProfileCollection.from_documents(data, meta)
+    return profile_list(data, meta)
+
+def profile_list(data, meta):
+    # pair up the data documents <data> and metadata documents <meta> found by a profile search into a list of Profile objects;
+    # the profiles take over the data documents, and share the metadata documents among themselves.
+
     metalookup = {x['_id']: x for x in meta}
 
-    return [Profile(x, metalookup[x['metadata'][0]]) for x in data]
+    return [Profile(x, metalookup[x['metadata'][0]], share=True) for x in data]
 
 def profile_is_empty(data, data_info):
     # check if a profile is nothing but nan / none in every variable except pressure
@@ -524,76 +1372,58 @@ def glodap_levels():
     # return the standard levels in dbar used in GLODAPv2 climatology
     return [0, 10, 20, 30, 50, 75, 100, 125, 150, 200, 250, 300, 400, 500, 600, 700, 800, 900, 1000, 1100, 1200, 1300, 1400, 1500, 1750, 2000, 2500, 3000, 3500, 4000, 4500, 5000, 5500]
 
-def build_dataset(interpolated_profiles, levels):
+def build_dataset(interpolated_profiles, levels, dtype=float):
     # munge into an xarray dataset dimensioned by a profile index and levels, in analogy to Argo GDAC files
     # <interpolated_profiles> is a list of Argovis profile JSON or a list of Profile objects which must all have the same level spectrum
     # <levels> is a list of floats labeling the levels.
+    # <interpolated_profiles> can also be a ProfileCollection, with every profile on <levels>.
+    # <dtype> is as for grid_dataset.
 
     # shred Profiles or json into the information we need
-    nprofs = range(len(interpolated_profiles))
     darray = {}
-    ids = []
-    longitudes = []
-    latitudes = []
-    timestamps = []
-    if isinstance(interpolated_profiles[0], Profile):
-        ## Profile objects
-        variables = [p.variable_names() for p in interpolated_profiles]
-        vars = list({x for sub in variables for x in sub})
-        vars.sort()
-
-        ### empty block for variables
-        for v in vars:
+    if isinstance(interpolated_profiles, ProfileCollection):
+        ## columnar collection, variables are already (profile, level) blocks
+        c = interpolated_profiles
+        if c.offsets[-1] != len(c) * len(levels):
+            raise Exception('all variables in all profiles must be interpolated to a consistent set of levels, as described by the <levels> argument.')
+        for v in c.variable_names():
             if not v == 'pressure':
-                darray[v] = (('nprof', 'level'), numpy.full((len(nprofs), len(levels)), numpy.nan, dtype=float))
-
-        #### fill in variables
-        for i, p in enumerate(interpolated_profiles):
-            prof_idx = i
-            for v in vars:
-                if v in p.variable_names() and not v == 'pressure':
-                    var = p.getvar(v)
-                    if len(var) != len(levels):
-                        raise Exception('all variables in all profiles must be interpolated to a consistent set of levels, as described by the <levels> argument.')
-                    for j,val in enumerate(var):
-                        lvl_idx = j
-                        darray[v][1][prof_idx][lvl_idx] = val
-
-        #### form coordinates
-        ids = [p.id for p in interpolated_profiles]
-        longitudes = [p.longitude for p in interpolated_profiles]
-        latitudes = [p.latitude for p in interpolated_profiles]
-        timestamps = [p.timestamp for p in interpolated_profiles]
-        timestamps = [parsetime(t) for t in timestamps]
+                darray[v] = (('nprof', 'level'), c.matrix(v).astype(storage_dtype(dtype)))
+        ids = list(c.ids)
+        longitudes = c.longitudes
+        latitudes = c.latitudes
+        timestamps = c.timestamps.astype('datetime64[ns]')
     else:
-        ## JSON docs
-        variables = [p['data_info'][0] for p in interpolated_profiles]
-        vars = list({x for sub in variables for x in sub})
+        if isinstance(interpolated_profiles[0], Profile):
+            ## Profile objects
+            names = [p.variable_names() for p in interpolated_profiles]
+            columns = [[p.getvar(v) for v in n] for p, n in zip(interpolated_profiles, names)]
+            rawdata = [p.rawdata for p in interpolated_profiles]
+        else:
+            ## JSON docs
+            names = [p['data_info'][0] for p in interpolated_profiles]
+            columns = [p['data'] for p in interpolated_profiles]
+            rawdata = interpolated_profiles
+        vars = list({x for sub in names for x in sub if x != 'pressure'})
         vars.sort()
 
-        ### empty block for variables
+        ### stack each variable's vectors into its (profile, level) block in one go, with nan rows for profiles without it
+        index = [dict(zip(n, range(len(n)))) for n in names]
+        empty = [numpy.nan]*len(levels)
         for v in vars:
-            if not v == 'pressure':
-                darray[v] = (('nprof', 'level'), numpy.full((len(nprofs), len(levels)), numpy.nan, dtype=float))
-
-        ### fill in variables
-        for i, p in enumerate(interpolated_profiles):
-            prof_idx = i
-            for v in vars:
-                if v in p['data_info'][0] and not v == 'pressure':
-                    v_idx = p['data_info'][0].index(v)
-                    if len(p['data'][v_idx]) != len(levels):
-                        raise Exception('all variables in all profiles must be interpolated to a consistent set of levels, as described by the <levels> argument.')
-                    for j,val in enumerate(p['data'][v_idx]):
-                        lvl_idx = j
-                        darray[v][1][prof_idx][lvl_idx] = val
+            rows = [cols[idx[v]] if v in idx else empty for cols, idx in zip(columns, index)]
+            if any(len(r) != len(levels) for r in rows):
+                raise Exception('all variables in all profiles must be interpolated to a consistent set of levels, as described by the <levels> argument.')
+            darray[v] = (('nprof', 'level'), numpy.array(rows, dtype=storage_dtype(dtype)))
 
         ### form coordinates
-        ids = [p['_id'] for p in interpolated_profiles]
-        longitudes = [p['geolocation']['coordinates'][0] for p in interpolated_profiles]
-        latitudes = [p['geolocation']['coordinates'][1] for p in interpolated_profiles]
-        timestamps = [p['timestamp'] for p in interpolated_profiles]
-        timestamps = [parsetime(t) for t in timestamps]
+        ids = [p['_id'] for p in rawdata]
+        longitudes = numpy.array([p['geolocation']['coordinates'][0] for p in rawdata], dtype=float)
+        latitudes = numpy.array([p['geolocation']['coordinates'][1] for p in rawdata], dtype=float)
+        timestamps = parsetimes([p['timestamp'] for p in rawdata])
+        if isinstance(interpolated_profiles[0], Profile):
+            # Profile timestamps have always been labeled with strings
+            timestamps = parsetimes(timestamps)
 
     coords = {
         "id": ("nprof", ids),
@@ -604,7 +1434,7 @@ def build_dataset(interpolated_profiles, levels):
     }
 
     attrs = {}
-    return xarray.Dataset(darray,coords,attrs)
+    return pack_dataset(xarray.Dataset(darray,coords,attrs), dtype)
 
 def setvar(profile, varname, values, data_info_meta=None):
     # set a new variable on a JSON profile, in analogy to Profile.setvar
@@ -642,9 +1472,15 @@ class Profile:
     rawmeta: dict[str, Any] = field(default_factory=dict)
     vars: dict[str, numpy.ndarray] = field(default_factory=dict, repr=False)
 
-    def __init__(self, data, meta=None):
-        self._rawdata = copy.deepcopy(data)
-        self._rawmeta = copy.deepcopy(meta)
+    def __init__(self, data, meta=None, share=False):
+        # <share>=True takes ownership of the data document <data> and shares the metadata document <meta> by reference rather than copying them,
+        # for when there are many profiles to build and nothing else will modify either; rawdata and rawmeta should then be treated as read-only.
+        if share:
+            self._rawdata = {k: v for k, v in data.items() if k != 'data'}
+            self._rawmeta = meta
+        else:
+            self._rawdata = {k: copy.deepcopy(v) for k, v in data.items() if k != 'data'}
+            self._rawmeta = copy.deepcopy(meta)
         
         data_info = [[],[],[]]
         if 'data_info' in data:
@@ -653,10 +1489,17 @@ class Profile:
             data_info = meta['data_info']
 
         self.vars = {}
-        for i, name in enumerate(data_info[0]):
-            arr = numpy.ma.masked_invalid(numpy.array(data['data'][i], dtype=float))
-            self.vars[name] = arr
-        del self._rawdata['data']
+        if len(data_info[0]) > 0:
+            try:
+                # convert every variable at once; each is then a view on a row of the block
+                values = numpy.array(data['data'], dtype=float)
+                if values.ndim != 2:
+                    raise ValueError(values.shape)
+            except (ValueError, TypeError):
+                # variables of different lengths have to be converted one by one
+                values = [numpy.array(data['data'][i], dtype=float) for i in range(len(data_info[0]))]
+            for i, name in enumerate(data_info[0]):
+                self.vars[name] = numpy.ma.MaskedArray(values[i], mask=~numpy.isfinite(values[i]), copy=False)
 
         # dict for arbitrary annotations
         self.attrs = {}
@@ -678,7 +1521,7 @@ class Profile:
 
     @property
     def timestamp(self):
-        return parser.parse(self.rawdata['timestamp'], ignoretz=True)
+        return parsetimes([self.rawdata['timestamp']])[0].item()
 
     @property
     def longitude(self):
@@ -717,3 +1560,112 @@ class Profile:
 
     def delvar(self, name):
         del self.vars[name]
+
+    @classmethod
+    def view(cls, rawdata, rawmeta, vars):
+        # a Profile around the already built masked arrays in the dict <vars>, sharing <rawdata> and <rawmeta> as they are
+        p = cls.__new__(cls)
+        p._rawdata = rawdata
+        p._rawmeta = rawmeta
+        p.vars = vars
+        p.attrs = {}
+        return p
+
+class ProfileCollection(Sequence):
+    # a set of profiles stored column-wise rather than as a list of Profile objects, for when there are too many for that to be practical:
+    # every variable's levels for every profile are in one flat array, values[name], profile i's being values[name][offsets[i]:offsets[i+1]];
+    # levels missing from a profile's variable, and profiles without that variable at all, are nan, with present[name][i] False for the latter.
+    # ids, longitudes, latitudes and timestamps (as numpy.datetime64) are arrays with one entry per profile,
+    # and rawdata and rawmeta are the data documents (less their data) and metadata documents each profile came from.
+    # indexing or iterating hands out Profile views, whose variables are masked arrays viewing the flat arrays here, in sorted order.
+
+    def __init__(self, rawdata, rawmeta, offsets, values, present):
+        self.rawdata = rawdata
+        self.rawmeta = rawmeta
+        self.offsets = numpy.asarray(offsets, dtype=numpy.int64)
+        self.values = values
+        self.present = present
+        self.ids = numpy.array([d['_id'] for d in rawdata], dtype=object)
+        self.longitudes = numpy.array([d['geolocation']['coordinates'][0] for d in rawdata], dtype=float)
+        self.latitudes = numpy.array([d['geolocation']['coordinates'][1] for d in rawdata], dtype=float)
+        self.timestamps = parsetimes([d['timestamp'] for d in rawdata]).astype('datetime64[ms]')
+
+    @classmethod
+    def from_documents(cls, data, meta):
+        # collect the data documents <data> and metadata documents <meta> found by a profile search, in analogy to profile_list;
+        # the collection takes over the data documents, and shares the metadata documents among its profiles.
+
+        metalookup = {x['_id']: x for x in meta}
+        rawmeta = [metalookup[d['metadata'][0]] for d in data]
+        names = [(d['data_info'] if 'data_info' in d else m.get('data_info', [[]]))[0] for d, m in zip(data, rawmeta)]
+        columns = [d.get('data', []) for d in data]
+        rawdata = [{k: v for k, v in d.items() if k != 'data'} for d in data]
+        return cls.from_columns(rawdata, rawmeta, names, columns)
+
+    @classmethod
+    def from_profiles(cls, profiles):
+        # collect a list of Profile objects <profiles>, sharing their rawdata and rawmeta
+        names = [p.variable_names() for p in profiles]
+        columns = [[p.getvar(v) for v in n] for p, n in zip(profiles, names)]
+        return cls.from_columns([p.rawdata for p in profiles], [p.rawmeta for p in profiles], names, columns)
+
+    @classmethod
+    def from_columns(cls, rawdata, rawmeta, names, columns):
+        # build a collection from per-profile lists of variable <names> and matching lists of <columns> of values;
+        # each variable's values for every profile are converted in a single pass.
+
+        lengths = numpy.array([max((len(c) for c in cols), default=0) for cols in columns], dtype=numpy.int64)
+        offsets = numpy.concatenate([[0], numpy.cumsum(lengths)])
+        index = [dict(zip(n, range(len(n)))) for n in names]
+        values = {}
+        present = {}
+        for v in sorted({x for n in names for x in n}):
+            present[v] = numpy.array([v in idx for idx in index], dtype=bool)
+            # pad each profile's values out to its length with None, and stand in for the variable with all None where it's absent
+            flat = itertools.chain.from_iterable(
+                itertools.chain(cols[idx[v]], itertools.repeat(None, n - len(cols[idx[v]]))) if v in idx else itertools.repeat(None, n)
+                for cols, idx, n in zip(columns, index, lengths.tolist())
+            )
+            values[v] = numpy.array(list(flat), dtype=float)
+        return cls(rawdata, rawmeta, offsets, values, present)
+
+    def __len__(self):
+        return len(self.rawdata)
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self[j] for j in range(len(self))[i]]
+        if i < 0:
+            i += len(self)
+        return Profile.view(self.rawdata[i], self.rawmeta[i], {v: self.getvar(v, i, preserve_mask=True) for v in self.values if self.present[v][i]})
+
+    def variable_names(self):
+        return tuple(self.values.keys())
+
+    def hasvar(self, name, i):
+        # does profile <i> have variable <name>
+        return name in self.present and bool(self.present[name][i])
+
+    def getvar(self, name, i, preserve_mask=False):
+        # profile <i>'s values for variable <name>, as for Profile.getvar; a view on the flat array, not a copy
+        vals = self.values[name][self.offsets[i]:self.offsets[i+1]]
+        if preserve_mask:
+            return numpy.ma.MaskedArray(vals, mask=~numpy.isfinite(vals), copy=False)
+        return vals
+
+    def matrix(self, name):
+        # variable <name> as a (profile, level) array, for collections where every profile has the same number of levels, like after interpolation
+        lengths = numpy.diff(self.offsets)
+        if len(lengths) > 0 and (lengths != lengths[0]).any():
+            raise Exception('matrix needs every profile in the collection to have the same number of levels.')
+        return self.values[name].reshape(len(self), -1)
+
+    def on_levels(self, levels, values):
+        # a new collection of the same profiles, with every profile on <levels> and variables from the dict <values>
+        # of (profile, level) arrays; pressure is set to <levels>, and variables keep the presence they had here.
+        n = len(self)
+        vals = {v: numpy.asarray(a, dtype=float).reshape(-1) for v, a in values.items()}
+        vals['pressure'] = numpy.tile(numpy.asarray(levels, dtype=float), n)
+        present = {v: self.present[v] if v in self.present else numpy.ones(n, dtype=bool) for v in vals}
+        present['pressure'] = numpy.ones(n, dtype=bool)
+        return ProfileCollection(self.rawdata, self.rawmeta, numpy.arange(n+1) * len(levels), dict(sorted(vals.items())), present)
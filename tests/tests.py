@@ -1,6 +1,8 @@
 from argovisHelpers import helpers
 from argovisHelpers import analysis
-import datetime, pytest, numpy, scipy, xarray, gsw
+from argovisHelpers import aio
+from argovisHelpers import cache
+import datetime, pytest, numpy, scipy, xarray, gsw, time, asyncio, threading, json, requests, urllib3
 
 @pytest.fixture
 def apiroot():
@@ -24,6 +26,146 @@ def test_argofetch(apiroot, apikey):
     profile = helpers.argofetch('/argo', options={'id': '13857_068'}, apikey=apikey, apiroot=apiroot+'/')[0]
     assert len(profile) == 1, 'extra slashes betwen apiroot and route shouldnt matter'
 
+def test_argofetch_client(apiroot, apikey):
+    '''
+    check argofetch and query can share an explicit Client
+    '''
+
+    with helpers.Client(pool_size=2, retries=0) as client:
+        profile = helpers.argofetch('/argo', options={'id': '13857_068'}, apikey=apikey, apiroot=apiroot, client=client)[0]
+        assert len(profile) == 1, 'should have returned exactly one profile through an explicit client'
+        response = helpers.query('/tc', options={'startDate': '1851-05-26T00:00:00Z', 'endDate': '1852-01-01T00:00:00Z'}, apikey=apikey, apiroot=apiroot, client=client)
+        assert len(response) == 9, 'query should work the same through an explicit client'
+
+def test_Client():
+    '''
+    check Client connection pool configuration
+    '''
+
+    with helpers.Client(pool_size=16, timeout=(1, 2)) as client:
+        assert client.session.headers['x-avh-telemetry'] == helpers.telemetry_version(), 'telemetry header should be set once on the session'
+        assert client.session.get_adapter('https://argovis-api.colorado.edu/')._pool_maxsize == 16, 'pool size should be configurable'
+        assert client.timeout == (1, 2), 'timeout should be configurable'
+    assert helpers.default_client() is helpers.default_client(), 'default client should be shared'
+
+def test_argofetch_cache(apiroot, apikey, tmp_path):
+    '''
+    argofetch through a client with a ResponseCache should only go to the network once
+    '''
+
+    client = helpers.Client(cache=cache.ResponseCache(tmp_path))
+    first = helpers.argofetch('/argo', options={'id': '13857_068'}, apikey=apikey, apiroot=apiroot, client=client)[0]
+    second = helpers.argofetch('argo', options={'id': '13857_068'}, apikey=apikey, apiroot=apiroot+'/', client=client)[0]
+    assert first == second, 'cached response should match the original'
+    assert client.cache.stats()['hits'] == 1 and client.cache.stats()['misses'] == 1, 'second request should have been a cache hit'
+
+def test_ResponseCache(tmp_path):
+    '''
+    check basic behavior of ResponseCache
+    '''
+
+    c = cache.ResponseCache(tmp_path, default_ttl=100, ttl={'/grids': -1})
+    assert c.get('http://api:8080', 'argo', {'id': 'x'}) is None, 'empty cache should miss'
+    c.put('http://api:8080/', '/argo', {'id': 'x', 'data': 'all'}, [{'_id': 'x'}])
+    assert c.get('http://api:8080', 'argo/', {'data': 'all', 'id': 'x'}) == [{'_id': 'x'}], 'equivalent requests should share a cache entry'
+    c.put('http://api:8080', '/grids/rg09', {'id': 'y'}, [{'_id': 'y'}])
+    assert c.get('http://api:8080', '/grids/rg09', {'id': 'y'}) is None, 'route prefix ttl should apply, and stale entries miss'
+    assert c.stats() == {'hits': 1, 'misses': 2, 'entries': 1, 'bytes': c.stats()['bytes']}, f'unexpected stats {c.stats()}'
+
+    c = cache.ResponseCache(tmp_path / 'small', max_bytes=150)
+    c.put('http://api:8080', 'argo', {'id': 'a'}, list(range(20)))
+    c.put('http://api:8080', 'argo', {'id': 'b'}, list(range(20)))
+    c.get('http://api:8080', 'argo', {'id': 'a'})
+    c.put('http://api:8080', 'argo', {'id': 'c'}, list(range(20)))
+    assert c.get('http://api:8080', 'argo', {'id': 'b'}) is None, 'least recently used entry should be evicted'
+    assert c.get('http://api:8080', 'argo', {'id': 'a'}) is not None, 'recently used entry should survive eviction'
+
+def test_MetadataStore(tmp_path):
+    '''
+    check MetadataStore persists, evicts and feeds cache_metadata
+    '''
+
+    s = cache.MetadataStore(tmp_path, max_entries=2)
+    s.put('http://api:8080/', '/argo/meta', [{'_id': 'a', 'platform': 1}, {'_id': 'b', 'platform': 2}])
+    s.close()
+
+    s = cache.MetadataStore(tmp_path, max_entries=2)
+    assert s.get('http://api:8080', 'argo/meta', ['a', 'x']) == {'a': {'_id': 'a', 'platform': 1}}, 'stored documents should survive reopening'
+    s.put('http://api:8080', 'argo/meta', [{'_id': 'c', 'platform': 3}])
+    assert s.get('http://api:8080', 'argo/meta', ['a', 'b', 'c']).keys() == {'a', 'c'}, 'least recently used document should be evicted'
+
+    helpers._metacache.clear()
+    found, todo = helpers.cache_metadata('http://api:8080', '/argo', ['a', 'b'], s)
+    assert list(found) == ['a'] and todo == ['b'], 'cache_metadata should find stored documents and leave the rest to fetch'
+    assert helpers.cache_metadata('http://api:8080', '/argo', ['a'])[0] == found, 'stored documents should be promoted to the in-memory cache'
+    helpers._metacache.clear()
+
+def test_SliceJournal(tmp_path):
+    '''
+    check a SliceJournal survives reopening, including after a half written line, and refuses other queries
+    '''
+
+    path = tmp_path / 'checkpoint.jsonl'
+    ops = {'startDate': '2020-01-01T00:00:00Z', 'endDate': '2020-03-01T00:00:00Z'}
+    plan = [{**ops, 'endDate': '2020-02-01T00:00:00Z'}, {**ops, 'startDate': '2020-02-01T00:00:00Z'}]
+    j = helpers.SliceJournal(path, '/argo', ops, apiroot='http://api:8080')
+    assert j.plan is None, 'new journal should have no plan'
+    j.start(plan, False)
+    j.record(1, [{'_id': 'b'}])
+    with open(path, 'a') as f:
+        f.write('{"slice": 0, "docs": [{"_i')
+
+    j = helpers.SliceJournal(path, 'argo/', ops, apiroot='http://api:8080/')
+    assert j.plan == plan and j.spatial is False, 'plan should be read back from journal'
+    assert list(j.done) == [1], 'only complete slices should be read back'
+    assert j.docs(1) == [{'_id': 'b'}], 'slice documents should be read back'
+    j.record(0, [{'_id': 'a'}])
+    assert helpers.SliceJournal(path, '/argo', ops, apiroot='http://api:8080').docs(0) == [{'_id': 'a'}], 'appending should follow a truncated fragment cleanly'
+
+    with pytest.raises(Exception):
+        helpers.SliceJournal(path, '/argo', {**ops, 'data': 'all'}, apiroot='http://api:8080')
+
+def test_TTLCache():
+    '''
+    check eviction, expiry and stats of TTLCache
+    '''
+
+    c = helpers.TTLCache(maxsize=2, ttl=0.1)
+    c.put('a', 1)
+    c.put('b', 2)
+    assert c.get('a') == 1, 'fresh entry should be found'
+    c.put('c', 3)
+    assert c.get('b') is None, 'least recently used entry should be evicted past maxsize'
+    assert c.get('a') == 1 and c.get('c') == 3, 'recently used entries should survive eviction'
+    time.sleep(0.1)
+    assert c.get('a') is None, 'expired entry should miss'
+    assert c.stats() == {'size': 1, 'maxsize': 2, 'hits': 3, 'misses': 2, 'hit_rate': 0.6}, f'unexpected stats {c.stats()}'
+
+    c.put_many([('d', 4), ('e', 5)])
+    assert c.get('d') == 4 and c.get('e') == 5 and c.stats()['size'] == 2, 'put_many should store every pair, dropping expired entries'
+
+def test_TTLCache_single_flight():
+    '''
+    concurrent misses on the same key should share one fetch
+    '''
+
+    c = helpers.TTLCache()
+    calls = []
+
+    def fetch():
+        calls.append(1)
+        time.sleep(0.1)
+        return 'value'
+
+    results = []
+    threads = [threading.Thread(target=lambda: results.append(c.get_or_fetch('key', fetch))) for i in range(8)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert results == ['value']*8, 'every caller should get the fetched value'
+    assert len(calls) == 1, 'only one caller should have fetched'
+
 def test_argofetch_404(apiroot, apikey):
     '''
     check various flavors of 404
@@ -106,6 +248,20 @@ def test_parsetime(apiroot, apikey):
     assert helpers.parsetime(datestring) == dtime, 'date string should have been converted to datetime.datetime'
     assert helpers.parsetime(helpers.parsetime(datestring)) == datestring, 'parsetime should be its own inverse'
 
+def test_parsetimes():
+    '''
+    check parsetimes agrees with parsetime, in both directions, for whole lists of timestamps
+    '''
+
+    datestrings = ['1999-12-31T23:59:59.999999Z', '0001-12-31T23:59:59.999999Z', '2022-02-01T19:03:42.002000Z']
+    times = helpers.parsetimes(datestrings)
+
+    assert times.dtype == numpy.dtype('datetime64[us]'), 'date strings should have been converted to datetime64'
+    assert [t.item() for t in times] == [helpers.parsetime(d) for d in datestrings], 'parsetimes should agree with parsetime'
+    assert list(helpers.parsetimes(times)) == datestrings, 'parsetimes should be its own inverse'
+    assert list(helpers.parsetimes(['2022-02-01T19:03:42Z'])) == list(helpers.parsetimes(['2022-02-01T19:03:42.000Z'])), 'fractional seconds should be optional'
+    assert helpers.parsetimes(['Feb 1 2022'])[0] == numpy.datetime64('2022-02-01'), 'other formats should fall back to a general parser'
+
 def test_query(apiroot, apikey):
     '''
     check basic behavior of query
@@ -124,6 +280,314 @@ def test_big_poly(apiroot, apikey):
     assert len(response) == 9, f'should be able to query entire globe for 6 months, with time divisions landing exactly on one timestamp, and get back 9 tcs, instead got {len(response)}'
 
 
+def test_concurrent_slices(apiroot, apikey):
+    '''
+    sliced queries should come back the same no matter how many workers fetch the slices
+    '''
+
+    options = {'startDate': '1851-05-26T00:00:00Z', 'endDate': '1852-01-01T00:00:00Z', 'polygon': [[-40,60],[-100,60],[-100,-60],[-40,-60],[-40,60]]}
+    serial = helpers.query('/tc', options=options, apikey=apikey, apiroot=apiroot, slice=True, workers=1)
+    concurrent = helpers.query('/tc', options=options, apikey=apikey, apiroot=apiroot, slice=True, workers=8)
+    assert [x['_id'] for x in serial] == [x['_id'] for x in concurrent], 'concurrent slicing should reproduce serial slicing, in order'
+
+def test_iter_query(apiroot, apikey):
+    '''
+    iter_query should stream the same documents query returns, sliced or not
+    '''
+
+    options = {'startDate': '1851-05-26T00:00:00Z', 'endDate': '1852-01-01T00:00:00Z', 'polygon': [[-40,60],[-100,60],[-100,-60],[-40,-60],[-40,60]]}
+    response = helpers.query('/tc', options=options, apikey=apikey, apiroot=apiroot)
+    stream = helpers.iter_query('/tc', options=options, apikey=apikey, apiroot=apiroot)
+    assert not isinstance(stream, list), 'iter_query should be lazy'
+    assert sorted([x['_id'] for x in stream]) == sorted([x['_id'] for x in response]), 'iter_query should find the same documents as query'
+
+    sliced = helpers.sliced_query('/tc', options=options, apikey=apikey, apiroot=apiroot)
+    assert sorted([x['_id'] for x in sliced]) == sorted([x['_id'] for x in response]), 'incremental reconciliation of slices should find the same documents as query'
+
+def test_iter_query_responses(monkeypatch):
+    '''
+    iter_query should yield nothing for an empty search or a 404, and raise on any other response that isn't a list of documents
+    '''
+
+    responses = {'/empty': [], '/none': {'code': 404, 'message': 'No documents found matching search.'}, '/docs': [{'_id': 'a'}], '/error': {'code': 500, 'message': 'oops'}}
+    monkeypatch.setattr(helpers, 'argofetch', lambda route, **kwargs: (responses[route], 0))
+    assert list(helpers.iter_query('/empty')) == [] and list(helpers.iter_query('/none')) == [], 'empty searches should yield nothing'
+    assert list(helpers.iter_query('/docs')) == [{'_id': 'a'}], 'documents should be yielded'
+    with pytest.raises(Exception):
+        list(helpers.iter_query('/error'))
+
+def test_reconcile_slices():
+    '''
+    check basic behavior of reconcile_slices
+    '''
+
+    results = [{'_id': 'a'}, {'_id': 'b'}, {'_id': 'x'}, {'_id': 'a'}, {'_id': 'c'}]
+    kept, to_add = helpers.reconcile_slices(results, ['a', 'b', 'c', 'd', 'e'])
+    assert kept == [{'_id': 'a'}, {'_id': 'b'}, {'_id': 'c'}], f'should deduplicate and drop unmatched documents in order, got {kept}'
+    assert to_add == ['d', 'e'], f'should identify missing ids, got {to_add}'
+
+def test_missing_plan():
+    options = {'startDate': '2000-01-01T00:00:00Z', 'endDate': '2001-01-01T00:00:00Z', 'polygon': [[0,0],[1,0],[1,1],[0,0]], 'data': 'temperature'}
+    assert helpers.missing_plan(options, ['a', 'b']) == [{'data': 'temperature', 'id': 'a'}, {'data': 'temperature', 'id': 'b'}], 'missing documents should be fetched by id with the same data options'
+
+def test_document_id():
+    assert helpers.document_id({'_id': 'abc', 'data': []}) == 'abc', 'should find _id of full document'
+    assert helpers.document_id(['abc', 1, 2]) == 'abc', 'should find _id of minimal document'
+
+def test_slice_plan():
+    '''
+    check basic behavior of slice_plan
+    '''
+
+    plan, spatial = helpers.slice_plan('/timeseries/ccmpwind', {'startDate':'1995-01-01T00:00:00Z', 'endDate':'2019-01-01T00:00:00Z', 'box': [[0,0],[10,10]]}, sizer=helpers.SliceSizer())
+    assert spatial, 'timeseries should always be sliced in space'
+    assert [x['box'] for x in plan] == [[[0,0],[5,5]], [[0,5],[5,10]], [[5,0],[10,5]], [[5,5],[10,10]]], f'box should be cut into 5x5 cells, got {plan}'
+    assert all(x['startDate'] == '1995-01-01T00:00:00Z' for x in plan), 'other options should be carried onto every slice'
+
+    plan, spatial = helpers.slice_plan('/argo', {'startDate':'2000-01-01T00:00:00Z', 'endDate':'2000-03-01T00:00:00Z', 'box': [[-180,-90],[180,90]]}, sizer=helpers.SliceSizer())
+    assert not spatial, 'short global search should be sliced in time'
+    assert plan[0]['startDate'] == '2000-01-01T00:00:00.000000Z' and plan[-1]['endDate'] == '2000-03-01T00:00:00.000000Z', 'time slices should span the whole search'
+    assert all(plan[i]['endDate'] == plan[i+1]['startDate'] for i in range(len(plan)-1)), 'time slices should be contiguous'
+
+def test_adaptive_slice_plan():
+    '''
+    slice_plan should size slices by what a SliceSizer has learned about a route
+    '''
+
+    options = {'startDate':'1995-01-01T00:00:00Z', 'endDate':'1996-01-01T00:00:00Z', 'box': [[0,0],[40,40]]}
+    sizer = helpers.SliceSizer(target_docs=1000)
+    plan, spatial = helpers.slice_plan('/timeseries/ccmpwind', options, sizer=sizer)
+    assert len(plan) == 64, 'nothing learned yet, should use 5x5 cells'
+
+    sizer.observe('timeseries/ccmpwind', 1e9, 10)
+    plan, spatial = helpers.slice_plan('/timeseries/ccmpwind', options, sizer=sizer)
+    assert len(plan) == 1, 'sparse route should be covered by as few cells as possible'
+
+    sizer.rejected('/timeseries/ccmpwind', 1e5)
+    plan, spatial = helpers.slice_plan('/timeseries/ccmpwind', options, sizer=sizer)
+    assert 1 < len(plan) < 64, 'cells should shrink to fit under bulk that was rejected'
+
+def test_split_slice():
+    '''
+    check basic behavior of split_slice
+    '''
+
+    assert helpers.split_slice({'box': [[0,0],[10,10]], 'data': 'all'}, True) == [{'box': [[0,0],[5.0,5.0]], 'data': 'all'}, {'box': [[0,5.0],[5.0,10]], 'data': 'all'}, {'box': [[5.0,0],[10,5.0]], 'data': 'all'}, {'box': [[5.0,5.0],[10,10]], 'data': 'all'}], 'box should be cut in quarters'
+    assert len(helpers.split_slice({'polygon': [[0,0],[10,0],[10,10],[0,10],[0,0]]}, True)) == 4, 'polygon should be cut in quarters'
+    assert helpers.split_slice({'startDate': '2000-01-01T00:00:00Z', 'endDate': '2000-01-03T00:00:00Z'}, False) == [{'startDate': '2000-01-01T00:00:00Z', 'endDate': '2000-01-02T00:00:00.000000Z'}, {'startDate': '2000-01-02T00:00:00.000000Z', 'endDate': '2000-01-03T00:00:00Z'}], 'time window should be cut in half'
+    assert helpers.split_slice({'startDate': '2000-01-01T00:00:00Z', 'endDate': '2000-01-01T00:00:10Z'}, False) is None, 'tiny slices shouldnt be cut further'
+
+def test_SliceSizer():
+    sizer = helpers.SliceSizer(maxbulk=1000, target_docs=10)
+    assert sizer.limit('argo') is None, 'nothing learned about route'
+    sizer.observe('/argo/', 100, 50)
+    assert sizer.limit('argo') == 20, 'limit should aim for target_docs at the observed density'
+    sizer.rejected('argo', 10)
+    assert sizer.limit('argo') == 9, 'limit should drop below bulk the API rejected'
+    assert sizer.limit('argo', apiroot='http://api:8080') is None, 'what was learned about one API root should not apply to another'
+    for i in range(5):
+        sizer.observe('argo', 5, 0)
+    assert sizer.limit('argo') > 9, 'accepted slices should let the limit grow back'
+
+    sizer = helpers.SliceSizer(maxbulk=1e9, target_docs=10)
+    sizer.observe('argo', 100, 50)
+    for i in range(20):
+        sizer.observe('argo', 100, 1)
+    assert sizer.limit('argo') > 500, 'the density should follow recent slices, rather than every slice ever seen'
+
+def test_RateLimiter():
+    '''
+    check a throttled RateLimiter holds off requests and then paces them
+    '''
+
+    limiter = helpers.RateLimiter()
+    start = time.monotonic()
+    limiter.acquire()
+    assert time.monotonic() - start < 0.05, 'fresh limiter shouldnt block'
+    limiter.throttle(0.2, 0.1)
+    limiter.acquire()
+    limiter.acquire()
+    assert time.monotonic() - start >= 0.3, 'throttled limiter should wait out the delay, then pace by latency'
+
+def test_RetryPolicy():
+    '''
+    check RetryPolicy backs off within bounds and respects its retry limits
+    '''
+
+    policy = helpers.RetryPolicy(retries=3, backoff=1, max_backoff=3)
+    waits = [policy.wait(i) for i in range(4)]
+    assert all(0 <= w <= b for w, b in zip(waits[:3], [1, 2, 3])), f'waits {waits} should be bounded by capped exponential backoff'
+    assert waits[3] is None, 'should give up after the allowed number of retries'
+
+    policy = helpers.RetryPolicy(budget=2)
+    assert policy.wait(0) is not None and policy.wait(0) is not None, 'retries within budget should be allowed'
+    assert policy.wait(0) is None, 'retries beyond the shared budget should not be allowed'
+
+def test_RetryPolicy_only_retries(monkeypatch):
+    '''
+    check a Client's RetryPolicy is the only thing retrying failed connections, so its budget bounds the attempts made
+    '''
+
+    attempts = []
+    def refuse(*args, **kwargs):
+        attempts.append(1)
+        raise ConnectionRefusedError('refused')
+    monkeypatch.setattr(urllib3.util.connection, 'create_connection', refuse)
+
+    with helpers.Client(retry=helpers.RetryPolicy(retries=4, backoff=0, budget=2)) as client:
+        with pytest.raises(requests.exceptions.ConnectionError):
+            helpers.argofetch('/argo', apiroot='http://127.0.0.1:9', client=client)
+    assert len(attempts) == 3, f'should connect once, then retry only within the budget, made {len(attempts)} attempts'
+    assert helpers.Client(retries=1).retry.retries == 1, 'retries should set the RetryPolicy'
+
+def test_StreamDecoder():
+    '''
+    check StreamDecoder decodes bodies fed to it a few bytes at a time exactly as a single decode would
+    '''
+
+    docs = [{'_id': str(i), 'note': '},{', 'source': [{'a': i}, {'b': [i, i]}]} for i in range(50)]
+    bodies = [json.dumps(docs), json.dumps([[i, 'a'] for i in range(50)]), '[]', '{"code": 404, "message": "not found"}']
+    for body in bodies:
+        for n in (1, 7, 1000):
+            decoder = helpers.StreamDecoder()
+            for i in range(0, len(body), n):
+                decoder.feed(body[i:i+n].encode())
+            assert decoder.result() == json.loads(body), f'body fed {n} bytes at a time should decode the same as all at once'
+
+    decoder = helpers.StreamDecoder()
+    decoder.feed(b'<html>502 Bad Gateway</html>')
+    with pytest.raises(ValueError):
+        decoder.result()
+    assert decoder.text() == '<html>502 Bad Gateway</html>', 'a body that is not JSON should be available as text'
+
+    decoder = helpers.StreamDecoder()
+    decoder.feed(json.dumps(docs)[:-20].encode())
+    with pytest.raises(ValueError):
+        decoder.result()
+
+    with pytest.raises(Exception) as e:
+        helpers.check_status(200, None, '<html>')
+    assert e.value.args == (200, '<html>'), 'a success whose body is not JSON should raise with the start of the body'
+
+def test_aio_query(apiroot, apikey):
+    '''
+    async query should find the same things as the sync query, sliced or not
+    '''
+
+    options = {'startDate': '1851-05-26T00:00:00Z', 'endDate': '1852-01-01T00:00:00Z', 'polygon': [[-40,60],[-100,60],[-100,-60],[-40,-60],[-40,60]]}
+    sync = helpers.query('/tc', options=options, apikey=apikey, apiroot=apiroot)
+    unsliced = asyncio.run(aio.query('/tc', options=options, apikey=apikey, apiroot=apiroot))
+    sliced = asyncio.run(aio.query('/tc', options=options, apikey=apikey, apiroot=apiroot, slice=True))
+    assert [x['_id'] for x in unsliced] == [x['_id'] for x in sync], 'async query should match sync query'
+    assert sorted([x['_id'] for x in sliced]) == sorted([x['_id'] for x in sync]), 'sliced async query should find the same documents as sync query'
+
+def test_aio_queryProfile(apiroot, apikey):
+    '''
+    async queryProfile should build the same Profiles as the sync version
+    '''
+
+    profiles = asyncio.run(aio.queryProfile('/argo', options={'id': '13857_068', 'data':'pressure,temperature'}, apikey=apikey, apiroot=apiroot))
+    assert profiles[0].id == '13857_068', 'fetched wrong profile'
+    assert numpy.all(profiles[0].getvar('temperature')[0:5] == [28.021,28,27.969,27.969,27.969]), 'temperature data should be correct'
+
+def test_aio_acquire():
+    '''
+    async acquire should wait out a throttled RateLimiter without blocking other coroutines
+    '''
+
+    limiter = helpers.RateLimiter()
+    limiter.throttle(0.2, 0)
+    ticks = []
+
+    async def tick():
+        for i in range(3):
+            ticks.append(time.monotonic())
+            await asyncio.sleep(0.05)
+
+    async def run():
+        start = time.monotonic()
+        await asyncio.gather(aio.acquire(limiter), tick())
+        return start
+
+    start = asyncio.run(run())
+    assert time.monotonic() - start >= 0.2, 'acquire should wait for the throttle to clear'
+    assert len(ticks) == 3 and ticks[-1] - start < 0.2, 'other coroutines should keep running while acquire waits'
+
+def test_aio_query_metadata_off_loop(monkeypatch):
+    '''
+    async query_metadata should wait for the metadata cache's lock without blocking other coroutines
+    '''
+
+    meta = [{'_id': 'm0'}]
+    async def argofetch(route, options={}, **kwargs):
+        return meta, 0
+    monkeypatch.setattr(aio, 'argofetch', argofetch)
+    helpers._metacache.clear()
+    ticks = []
+
+    async def tick():
+        for i in range(3):
+            ticks.append(time.monotonic())
+            await asyncio.sleep(0.05)
+
+    async def run():
+        start = time.monotonic()
+        found, _ = await asyncio.gather(aio.query_metadata('/argo', [{'metadata': ['m0']}], apiroot='http://api:8080', session=object()), tick())
+        return start, found
+
+    with helpers._metacache._lock:
+        # held by this thread while the event loop runs in another
+        result = []
+        loop = threading.Thread(target=lambda: result.append(asyncio.run(run())))
+        loop.start()
+        time.sleep(0.2)
+    loop.join()
+    start, found = result[0]
+    assert found == meta, 'should find the metadata once the lock is released'
+    assert len(ticks) == 3 and ticks[-1] - start < 0.2, 'other coroutines should keep running while the cache is locked'
+    helpers._metacache.clear()
+
+def test_aio_retry_policy(monkeypatch):
+    '''
+    the async query functions should make every request under the RetryPolicy they're given
+    '''
+
+    policy = helpers.RetryPolicy(retries=1, budget=3)
+    seen = []
+    async def argofetch(route, options={}, retry=None, **kwargs):
+        seen.append(retry)
+        if options.get('batchmeta'):
+            return [{'_id': 'm0'}], 0
+        return [{'_id': 'p0', 'metadata': ['m0']}], 0
+    monkeypatch.setattr(aio, 'argofetch', argofetch)
+    helpers._metacache.clear()
+
+    asyncio.run(aio.queryProfile('/argo', options={'id': 'p0'}, apiroot='http://api:8080', session=object(), retry=policy))
+    assert len(seen) == 2 and all(r is policy for r in seen), 'data and metadata requests should both follow the given policy'
+    helpers._metacache.clear()
+
+def test_aio_query_metadata_store(monkeypatch, tmp_path):
+    '''
+    async query_metadata should keep what it finds in a MetadataStore, and find it there again
+    '''
+
+    meta = [{'_id': 'm0'}, {'_id': 'm1'}]
+    calls = []
+    async def argofetch(route, options={}, **kwargs):
+        calls.append(route)
+        return meta, 0
+    monkeypatch.setattr(aio, 'argofetch', argofetch)
+    data = [{'metadata': ['m0']}, {'metadata': ['m1']}]
+
+    store = cache.MetadataStore(tmp_path)
+    helpers._metacache.clear()
+    assert asyncio.run(aio.query_metadata('/argo', data, apiroot='http://api:8080', session=object(), metadata=store)) == meta, 'should fetch uncached metadata'
+    helpers._metacache.clear()
+    assert asyncio.run(aio.query_metadata('/argo', data, apiroot='http://api:8080', session=object(), metadata=store)) == meta, 'should find stored metadata'
+    assert len(calls) == 1, 'stored metadata should not be fetched again'
+    store.close()
+    helpers._metacache.clear()
+
 def test_query_vocab(apiroot, apikey):
     '''
     check basic behavior of vocab query
@@ -232,6 +696,38 @@ def test_interpolate_to_levels():
     assert numpy.allclose(analysis.interpolate_to_levels(degen_levels, profile_temperature, [2,4,6])[0], [numpy.nan,40,numpy.nan], equal_nan=True), 'degenerate profile'
     assert numpy.allclose(analysis.interpolate_to_levels(degen_levels, profile_temperature, [2,4,6])[1], 1), 'degenerate profile flagging'
 
+def test_interpolate_profiles():
+    '''
+    batch interpolation should match interpolate_to_levels profile by profile and variable by variable
+    '''
+
+    levels = [0, 5, 10, 20, 30, 50, 100, 200]
+    pressures = [[1,2,5,11,30,60,90,150], [150,90,60,30,11,5,2,1], [3,1,2,8,20], [1,1,3,4,5,7], [5]]
+    temperature = [[10,12,9,8,8,7,5,4], [1,2,3,4,5,6,7,8], [1,2,3,numpy.nan,5], [1,2,3,4,5,6], [1]]
+    salinity = [[35,34,34,33,None,33,34,35], None, [1,1,1,1,1], [6,5,4,3,2,1], [2]]
+    values, flags = analysis.interpolate_profiles(pressures, {'temperature': temperature, 'salinity': salinity}, levels)
+
+    assert values['temperature'].shape == (5, 8), 'should have one row per profile and one column per level'
+    for name, vecs in (('temperature', temperature), ('salinity', salinity)):
+        for i in range(4):
+            if vecs[i] is None:
+                assert numpy.isnan(values[name][i]).all(), 'missing variables should interpolate to nan'
+                continue
+            interp, flag = analysis.interpolate_to_levels(pressures[i], vecs[i], levels)
+            assert numpy.allclose(values[name][i], interp.filled(numpy.nan), equal_nan=True), f'{name} for profile {i} should match interpolate_to_levels'
+            assert flags[name][i] == flag, f'{name} flag for profile {i} should match interpolate_to_levels'
+    assert numpy.isnan(values['temperature'][4]).all() and flags['temperature'][4] == 32, 'profiles with a single level should be flagged as insufficient'
+
+    parallel_values, parallel_flags = analysis.interpolate_parallel(pressures, {'temperature': temperature, 'salinity': salinity}, levels, workers=2, chunk_size=2)
+    for name in ('temperature', 'salinity'):
+        assert numpy.array_equal(parallel_values[name], values[name], equal_nan=True), f'parallel {name} should match, in order'
+        assert numpy.array_equal(parallel_flags[name], flags[name]), f'parallel {name} flags should match, in order'
+
+    masked = [numpy.ma.masked_array([1, 2, 3, 999], [False, False, False, True])]
+    serial, _ = analysis.interpolate_profiles([[0, 10, 20, 30]], {'temperature': masked}, [5, 15])
+    parallel, _ = analysis.interpolate_parallel([[0, 10, 20, 30]], {'temperature': masked}, [5, 15], workers=2)
+    assert numpy.array_equal(parallel['temperature'], serial['temperature'], equal_nan=True), 'masked values should stay masked in parallel'
+
 def test_profile_is_empty():
     mock_data_info = [['a', 'pressure', 'b'],[],[]]
 
@@ -247,6 +743,8 @@ def test_tidy_profile():
     assert analysis.tidy_profile([1,2,3,3,4], [6,7,8,9,10], 0) == ([1,2,4], [6,7,10], 1), 'mask degen neighbors'
     assert analysis.tidy_profile([6,5,4,3],[2,5,3,4], 0) == ([3,4,5,6], [4,3,5,2], 2), 'levels in reverse order'
     assert analysis.tidy_profile([1,2,4,3,5], [6,1,4,2,9], 0) == ([1,2,3,4,5], [6,1,2,4,9], 8), 'levels out of order'
+    assert analysis.tidy_profile([1,None,3,4,5], [6,7,None,numpy.nan,10], 0) == ([1,5], [6,10], 20), 'mask and flag missing values and pressures'
+    assert analysis.tidy_profile([3,1,2,1], [1,2,3,4], 0) == ([2,3], [3,1], 9), 'levels can become degenerate after sorting'
 
 def test_interpolate_all(apiroot, apikey):
 
@@ -272,6 +770,86 @@ def test_queryGrid(apiroot, apikey):
     assert datagrid.sizes['latitude'] == 1, 'test data has 1 latitude point'
     assert numpy.allclose(datagrid['rg09_temperature'].sel(longitude=20.5).data, [-0.033,-0.076,-0.21,-0.593,-1.201,-1.598,-1.663,-1.569,-1.15,-0.603,-0.134,0.262,0.6,0.861,1.057,1.184,1.249,1.259,1.279,1.307,1.315,1.329,1.342,1.349,1.345,1.33,1.309,1.284,1.263,1.245,1.224,1.203,1.175,1.127,1.07,1.013,0.955,0.896,0.843,0.792,0.748,0.7,0.661,0.621,0.584,0.549,0.52,0.489,0.464,0.441,0.415,0.383,0.356,0.309,0.265,0.219,0.175,0.128]), 'should be able to extract expected data'
 
+def test_queryGrid_store(apiroot, apikey, tmp_path):
+    '''
+    queryGrid into a Zarr store should be lazy, and otherwise the same as an in-memory queryGrid
+    '''
+
+    pytest.importorskip('zarr')
+    pytest.importorskip('dask')
+    options = {'startDate': '2004-01-01T00:00:00Z', 'endDate': '2004-03-01T00:00:00Z', 'data':'rg09_temperature'}
+    datagrid = helpers.queryGrid('/grids/rg09', options=options, apikey=apikey, apiroot=apiroot)
+    lazygrid = helpers.queryGrid('/grids/rg09', options=options, apikey=apikey, apiroot=apiroot, store=tmp_path / 'rg09.zarr')
+
+    assert lazygrid['rg09_temperature'].chunks is not None, 'stored grid should be backed by dask'
+    assert numpy.array_equal(lazygrid['rg09_temperature'].values, datagrid['rg09_temperature'].values, equal_nan=True), 'stored grid should match in-memory grid'
+
+def test_grid_dataset():
+    '''
+    check grid_dataset places every value in the right cell, for grids with level subsets and for timeseries
+    '''
+
+    meta = [{'_id': 'm', 'levels': [[0,10],[10,50],[50,100]]}]
+    data = [
+        {'_id': 'a', 'metadata': ['m'], 'timestamp': '2004-01-15T00:00:00Z', 'geolocation': {'coordinates': [20.5, -64.5]}, 'data': [[1,2,3],[4,5,6]], 'data_info': [['t','s'],[],[]]},
+        {'_id': 'b', 'metadata': ['m'], 'timestamp': '2004-02-15T00:00:00Z', 'geolocation': {'coordinates': [21.5, -64.5]}, 'data': [[7,8]], 'data_info': [['s'],[],[]], 'levels': [[10,50],[50,100]]}
+    ]
+    grid = helpers.grid_dataset(data, meta, {})
+    assert list(grid['level'].data) == ['0_10', '10_50', '50_100'], 'integral range levels should be labeled with strings'
+    assert numpy.array_equal(grid['s'].sel(longitude=21.5, latitude=-64.5).isel(timestamp=1).data, [numpy.nan, 7, 8], equal_nan=True), 'level subsets should land on their own levels'
+    assert numpy.array_equal(grid['t'].isel(timestamp=0, latitude=0).data, [[1,2,3],[numpy.nan]*3], equal_nan=True), 'cells without data should be nan'
+
+    meta = [{'_id': 'm', 'timeseries': ['2004-01-01T00:00:00.000Z', '2004-01-08T00:00:00.000Z']}]
+    data = [{'_id': 'c', 'metadata': ['m'], 'geolocation': {'coordinates': [0.5, 0.5]}, 'data': [[1,2]], 'data_info': [['sst'],[],[]]}]
+    ts = helpers.grid_dataset(data, meta, {})
+    assert numpy.array_equal(ts['sst'].data.flatten(), [1,2]), 'timeseries should be laid out along timestamp'
+
+def test_grid_dataset_dtype(tmp_path):
+    '''
+    check grid_dataset holds data as the requested dtype, and packs integer dtypes on writing
+    '''
+
+    meta = [{'_id': 'm', 'levels': [5, 10, 20]}]
+    data = [{'_id': 'a', 'metadata': ['m'], 'timestamp': '2004-01-15T00:00:00Z', 'geolocation': {'coordinates': [20.5, -64.5]}, 'data': [[1.25, None, -3.5]], 'data_info': [['t'],[],[]]}]
+    assert helpers.grid_dataset(data, meta, {}, dtype=numpy.float32)['t'].dtype == numpy.float32, 'float32 grids should be held as float32'
+
+    grid = helpers.grid_dataset(data, meta, {}, dtype='int16')
+    assert grid['t'].dtype == numpy.float32 and grid['t'].encoding['dtype'] == 'int16', 'int16 grids should be held as float32 and encoded as int16'
+    grid.to_netcdf(tmp_path / 'grid.nc')
+    packed = xarray.open_dataset(tmp_path / 'grid.nc')
+    assert numpy.allclose(packed['t'].values.flatten(), [1.25, numpy.nan, -3.5], equal_nan=True, atol=1e-3), 'packed grid should round trip, including nan'
+
+    # narrow ranges, where the packing step is down near float32 resolution
+    rng = numpy.random.default_rng(0)
+    values = {'sa': [35.1657, 35.1657], 'sigma0': [26.868, 26.857], **{f'v{i}': rng.uniform(-50, 50) + rng.uniform(0, 1e-3, 2) for i in range(100)}}
+    narrow = helpers.pack_dataset(xarray.Dataset({k: ('n', numpy.array(v, dtype=numpy.float32)) for k, v in values.items()}), 'int16')
+    narrow.to_netcdf(tmp_path / 'narrow.nc')
+    packed = xarray.open_dataset(tmp_path / 'narrow.nc')
+    for k, v in values.items():
+        assert numpy.allclose(packed[k].values, narrow[k].values, rtol=0, atol=2*narrow[k].encoding['scale_factor']), f'{k} should round trip without turning to nan, got {packed[k].values}'
+    assert packed['sigma0'].values[0] != packed['sigma0'].values[1], 'values a packing step apart should stay apart'
+
+def test_metadata_route():
+    '''
+    check metadata lookups go to the right route, once per distinct id
+    '''
+
+    assert helpers.metadata_route('/argo') == 'argo/meta', 'profile metadata should come from <collection>/meta'
+    assert helpers.metadata_route('grids/rg09/') == 'grids/meta', 'grid metadata should come from grids/meta'
+    assert helpers.metadata_route('/timeseries/noaasst') == 'timeseries/meta', 'timeseries metadata should come from timeseries/meta'
+    assert helpers.metadata_ids([{'metadata': ['b']}, {'metadata': ['a']}, {'metadata': ['b']}]) == ['b', 'a'], 'each metadata id should be listed once, in order'
+
+def test_queryProfile_metadata(apiroot, apikey):
+    '''
+    queryProfile should find the same metadata by id as a batchmeta search does
+    '''
+
+    options = {'startDate': '2017-08-01T00:00:00Z', 'endDate': '2017-09-01T00:00:00Z', 'polygon': [[-150,-30],[-155,-30],[-155,-35],[-150,-35],[-150,-30]]}
+    data = helpers.query('/argo', options=options, apikey=apikey, apiroot=apiroot)
+    batchmeta = helpers.query('/argo', options={**options, 'batchmeta': True}, apikey=apikey, apiroot=apiroot)
+    meta = helpers.query_metadata('/argo', data, options=options, apikey=apikey, apiroot=apiroot)
+    assert sorted([m['_id'] for m in meta]) == sorted([m['_id'] for m in batchmeta]), 'metadata by id should match batchmeta'
+
 def test_sort_and_dedupe(apiroot, apikey):
     assert helpers.sort_and_dedupe([5,4,3,2,1]) == [1,2,3,4,5], 'should sort list'
     assert helpers.sort_and_dedupe([1,2,3,4,5]) == [1,2,3,4,5], 'shouldnt mess with already sorted list'
@@ -288,6 +866,50 @@ def test_queryProfile(apiroot, apikey):
     assert profiles[0].variable_names() == ('pressure','temperature'), 'variable names incorrect'
     assert numpy.all(profiles[0].getvar('temperature')[0:5] == [28.021,28,27.969,27.969,27.969]), 'temperature data should be correct'
     
+def test_queryProfile_metadata_requests(monkeypatch):
+    '''
+    check queryProfile gets its metadata with one batchmeta request if the search isn't sliced, and one per slice if it is,
+    and that a few uncached ids are fetched one by one
+    '''
+
+    data = [{'_id': f'p{i}', 'metadata': [f'm{i}'], 'timestamp': str(numpy.datetime64('2022-01-01') + 2*i) + 'T12:00:00Z', 'geolocation': {'type': 'Point', 'coordinates': [0, 0]}, 'data_info': [['pressure'], [], []], 'data': [[10]]} for i in range(20)]
+    meta = [{'_id': f'm{i}'} for i in range(20)]
+    options = {'startDate': '2022-01-01T00:00:00Z', 'endDate': '2022-03-01T00:00:00Z'}
+    calls = []
+    def argofetch(route, options={}, **kwargs):
+        calls.append((route, options))
+        if route.endswith('meta'):
+            return [m for m in meta if m['_id'] == options['id']], 0
+        if slicing and options['startDate'] == '2022-01-01T00:00:00Z' and options['endDate'] == '2022-03-01T00:00:00Z':
+            raise Exception(413, {'code': 413})
+        window = [numpy.datetime64(options[t].rstrip('Z')) for t in ('startDate', 'endDate')]
+        found = [i for i in range(20) if window[0] <= numpy.datetime64(data[i]['timestamp'].rstrip('Z')) < window[1]]
+        return ([meta[i] for i in found] if 'batchmeta' in options else [data[i] for i in found]), 0
+    monkeypatch.setattr(helpers, 'argofetch', argofetch)
+
+    slicing = False
+    helpers._metacache.clear()
+    profiles = helpers.queryProfile('/argo', options=options, apiroot='http://api:8080', client=helpers.Client())
+    assert len(profiles) == 20 and len(calls) == 2 and calls[1][1].get('batchmeta'), f'should make one data and one batchmeta request, made {calls}'
+
+    slicing = True
+    helpers._metacache.clear()
+    calls.clear()
+    sizer = helpers.SliceSizer()
+    sizer.rejected('argo', helpers.search_bulk(options, 'argo') / 4, apiroot='http://api:8080')
+    found, plan = helpers.search('/argo', options=options, apiroot='http://api:8080', client=helpers.Client(), sizer=sizer)
+    assert plan is not None and 1 < len(plan) < 20 and len(found) == 20, f'sliced search should report its slice plan, got {plan}'
+    calls.clear()
+    found = helpers.query_metadata('/argo', data, options=options, apiroot='http://api:8080', client=helpers.Client(), plan=plan)
+    assert sorted(m['_id'] for m in found) == sorted(m['_id'] for m in meta), 'should find every metadata document'
+    assert len(calls) == len(plan) and all(c[1].get('batchmeta') for c in calls), f'more ids than slices should take one batchmeta request per slice, made {calls}'
+
+    helpers._metacache.clear()
+    calls.clear()
+    found = helpers.query_metadata('/argo', data[:3], apiroot='http://api:8080', client=helpers.Client(), plan=[{}] * 5)
+    assert found == meta[:3] and [r[0] for r in calls] == ['argo/meta'] * 3, 'no more ids than slices should be fetched by id'
+    helpers._metacache.clear()
+
 def test_build_dataset(apiroot,apikey):
     # on Profile objects:
     profiles = helpers.queryProfile('/cchdo', options={'startDate':'1996-01-01T00:00:00Z', 'endDate':'1997-01-01T00:00:00Z', 'data':'pressure,doxy'}, apikey=apikey, apiroot=apiroot)
@@ -303,6 +925,24 @@ def test_build_dataset(apiroot,apikey):
     assert len(interp_profiles) == ds.sizes['nprof']
     assert numpy.allclose(ds.isel(nprof=0)['doxy'].data, helpers.getvar('doxy', interp_profiles[0]), equal_nan=True), 'data shouldnt get mangled on conversion to dataset'
 
+def test_build_dataset_rows():
+    '''
+    build_dataset should lay each profile out along its row, with nan for variables it doesn't have, and reject mismatched levels
+    '''
+
+    docs = [
+        {'_id': 'a', 'timestamp': '2020-01-01T00:00:00.000Z', 'geolocation': {'type': 'Point', 'coordinates': [1, 2]}, 'data': [[10, 20], [1.5, None], [35, 36]], 'data_info': [['pressure','temperature','salinity'],[],[]]},
+        {'_id': 'b', 'timestamp': '2020-01-02T00:00:00.000Z', 'geolocation': {'type': 'Point', 'coordinates': [3, 4]}, 'data': [[10, 20], [2.5, 3.5]], 'data_info': [['pressure','temperature'],[],[]]}
+    ]
+    for profiles in [docs, [helpers.Profile(d) for d in docs]]:
+        ds = helpers.build_dataset(profiles, [10, 20])
+        assert numpy.array_equal(ds['temperature'].data, [[1.5, numpy.nan], [2.5, 3.5]], equal_nan=True), 'each profile should fill its own row'
+        assert numpy.array_equal(ds['salinity'].data, [[35, 36], [numpy.nan, numpy.nan]], equal_nan=True), 'missing variables should be nan'
+        assert list(ds['id'].data) == ['a', 'b'] and list(ds['longitude'].data) == [1, 3], 'coordinates should follow profiles'
+
+    with pytest.raises(Exception):
+        helpers.build_dataset(docs, [10, 20, 30])
+
 def test_setgetvar(apiroot, apikey):
     p = {'data': [[1,2,3,4,5], [10,20,30,40,50], [100,200,300,400,500]], 'data_info': [['temperature','pressure','salinity'],['units'],[['C','dbar','psu']]]}
     assert helpers.getvar('temperature', p) == [1,2,3,4,5], 'getvar should extract temperature'
@@ -323,6 +963,46 @@ def test_Profile(apiroot, apikey):
     p.setvar('salinity', [100,200,300,400,500])
     assert numpy.allclose(p.getvar('salinity'), [100,200,300,400,500]), 'setvar should have successfully posted salinity'
 
+def test_Profile_share():
+    '''
+    check Profiles built with share=True share metadata, and convert data the same as copying Profiles
+    '''
+
+    meta = {'_id': 'm', 'data_info': [['pressure','temperature'],['units'],[['dbar'],['C']]]}
+    data = {'_id': 'p', 'timestamp': '2022-02-01T19:03:42.002Z', 'geolocation': {'type': 'Point', 'coordinates': [-26.257, 3.427]}, 'data': [[1, 2, 3], [10.5, None, float('nan')]]}
+    copied = helpers.Profile(data, meta)
+    shared = helpers.Profile(data, meta, share=True)
+    assert copied.rawmeta is not meta and shared.rawmeta is meta, 'only shared Profiles should share metadata'
+    assert 'data' not in shared.rawdata and 'data' in data, 'data should be taken out of rawdata, without touching the original document'
+    for p in [copied, shared]:
+        assert numpy.ma.allequal(p.getvar('temperature', preserve_mask=True), numpy.ma.masked_array([10.5, 0, 0], [False, True, True])), 'None and nan should be masked'
+
+    ragged = helpers.Profile({**data, 'data': [[1, 2, 3], [10.5]]}, meta, share=True)
+    assert numpy.array_equal(ragged.getvar('temperature'), [10.5]), 'variables of different lengths should still be converted'
+
+def test_ProfileCollection():
+    '''
+    check a ProfileCollection stores profiles column-wise, hands out matching Profile views, and interpolates and builds datasets
+    '''
+
+    meta = [{'_id': 'm', 'data_info': [['pressure','temperature'],['units'],[['dbar'],['C']]]}]
+    data = [
+        {'_id': 'a', 'metadata': ['m'], 'timestamp': '2022-02-01T19:03:42.002Z', 'geolocation': {'type': 'Point', 'coordinates': [-26.257, 3.427]}, 'data': [[10, 20, 30], [10.5, None, 9.5]]},
+        {'_id': 'b', 'metadata': ['m'], 'timestamp': '2022-02-02T00:00:00Z', 'geolocation': {'type': 'Point', 'coordinates': [-26, 3]}, 'data': [[5, 15, 25, 35], [1, 2, 3, 4], [35, 35, 35, 35]], 'data_info': [['pressure','temperature','salinity'],[],[]]}
+    ]
+    c = helpers.ProfileCollection.from_documents(data, meta)
+    assert len(c) == 2 and list(c.offsets) == [0, 3, 7], 'offsets should follow profile lengths'
+    assert list(c.present['salinity']) == [False, True], 'presence should be tracked per variable'
+    assert c[0].variable_names() == ('pressure', 'temperature') and c[1].hasvar('salinity'), 'views should only have their own variables'
+    assert numpy.ma.allequal(c[0].getvar('temperature', preserve_mask=True), numpy.ma.masked_array([10.5, 0, 9.5], [False, True, False])), 'views should mask missing values'
+    assert c[-1].id == 'b' and c.timestamps[0] == numpy.datetime64('2022-02-01T19:03:42.002'), 'coordinates should be read from documents'
+
+    interpolated = analysis.interpolate_all(c, [15, 25])
+    expected = analysis.interpolate_to_levels([10,20,30], [10.5,numpy.nan,9.5], [15,25])[0].filled(numpy.nan)
+    assert numpy.allclose(interpolated.matrix('temperature'), [expected, [2, 3]], equal_nan=True), 'collections should interpolate like single profiles'
+    ds = helpers.build_dataset(interpolated, [15, 25])
+    assert ds['temperature'].shape == (2, 2) and numpy.isnan(ds['salinity'][0]).all(), 'build_dataset should take collections, with absent variables as nan'
+
 def test_MLD_estimate(apiroot, apikey):
     x = [0,1,2,3,4,5,6,7]
     y = [6.25,2.25,0.25,0.25,2.25,6.25,12.25,20.25]
@@ -339,6 +1019,30 @@ def test_MLD_mask(apiroot, apikey):
     pchip = scipy.interpolate.PchipInterpolator(x, y, extrapolate=False)
     assert numpy.isclose(pchip(root)[0], 0.28), 'MLD shouldnt be thrown off by a masked value far away'
 
+def test_MLD_profiles():
+    '''
+    batch MLD should match MLD_estimate profile by profile, in series or in parallel
+    '''
+
+    pressures = [[0,1,2,3,4,5,6,7], [0,1,2,3,4,5,6,7], [7,6,5,4,3,2,1,0], [0,5,8,15,40,50], [0,5,8,15,40,50]]
+    density = [[6.25,2.25,0.25,0.25,2.25,6.25,12.25,20.25], [6.25,2.25,0.25,0.25,2.25,6.25,12.25,numpy.nan], [20.25,12.25,6.25,2.25,0.25,0.25,2.25,6.25], [1,1,1.01,1.02,1.05,1.1], [1,1.01,1.02,1.02,1.02,1.02]]
+    references = [3, 3, 3, 10, 10]
+
+    for reference in set(references):
+        mld, flags = analysis.MLD_profiles(pressures, density, 0.03, reference_pressure=reference)
+        for i in [i for i in range(len(pressures)) if references[i] == reference]:
+            root, flag = analysis.MLD_estimate(pressures[i], density[i], 0.03, reference_pressure=reference)
+            assert (root is None and numpy.isnan(mld[i])) or numpy.isclose(mld[i], root), f'MLD for profile {i} should match MLD_estimate'
+            assert flags[i] == flag, f'flag for profile {i} should match MLD_estimate'
+
+        parallel_mld, parallel_flags = analysis.MLD_profiles(pressures, density, 0.03, reference_pressure=reference, workers=2, chunk_size=2)
+        assert numpy.array_equal(parallel_mld, mld, equal_nan=True) and numpy.array_equal(parallel_flags, flags), 'parallel MLD should match, in order'
+
+    masked = [numpy.ma.masked_array([1, 1, 1.01, 1.02, 0.5, 1.1], [False, False, False, False, True, False])]
+    serial = analysis.MLD_profiles([[0, 5, 8, 15, 40, 50]], masked, 0.03)
+    parallel = analysis.MLD_profiles([[0, 5, 8, 15, 40, 50]], masked, 0.03, workers=2)
+    assert numpy.array_equal(parallel[0], serial[0], equal_nan=True) and numpy.array_equal(parallel[1], serial[1]), 'masked values should stay masked in parallel'
+
 def test_AOU_estimate(apiroot, apikey):
     SA = [34.7118, 34.8915, 35.0256, 34.8472, 34.7366, 34.7324]
     CT = [28.8099, 28.4392, 22.7862, 10.2262, 6.8272, 4.3236]
@@ -359,6 +1063,39 @@ def test_AOU_estimate(apiroot, apikey):
 
     assert numpy.allclose(ref, O2_eq_umol_per_kg)
 
+def test_derive_teos10():
+    '''
+    check derive_teos10 computes the same TEOS-10 variables as gsw profile by profile, for collections and datasets
+    '''
+
+    meta = [{'_id': 'm', 'data_info': [['pressure','temperature','salinity','doxy'],['units'],[['dbar'],['C'],['psu'],['umol/kg']]]}]
+    data = [
+        {'_id': 'a', 'metadata': ['m'], 'timestamp': '2022-02-01T00:00:00Z', 'geolocation': {'type': 'Point', 'coordinates': [188, 4]}, 'data': [[10, 50, 125], [28.8, 28.4, 22.8], [34.7, 34.9, 35.0], [200, 190, 150]]},
+        {'_id': 'b', 'metadata': ['m'], 'timestamp': '2022-02-02T00:00:00Z', 'geolocation': {'type': 'Point', 'coordinates': [-26, 3]}, 'data': [[5, 15], [10.2, 6.8], [34.8, 34.7]], 'data_info': [['pressure','temperature','salinity'],[],[]]}
+    ]
+    c = helpers.ProfileCollection.from_documents(data, meta)
+    derived = analysis.derive_teos10(c, derived=('SA', 'CT', 'sigma0', 'AOU'))
+    for i, d in enumerate(data):
+        p, t, s = d['data'][0], d['data'][1], d['data'][2]
+        lon, lat = d['geolocation']['coordinates']
+        SA = gsw.SA_from_SP(s, p, lon, lat)
+        CT = gsw.CT_from_t(SA, t, p)
+        assert numpy.allclose(derived.getvar('SA', i), SA) and numpy.allclose(derived.getvar('CT', i), CT), f'SA and CT for profile {i} should match gsw'
+        assert numpy.allclose(derived.getvar('sigma0', i), gsw.sigma0(SA, CT)), f'sigma0 for profile {i} should match gsw'
+    aou, _ = analysis.AOU_estimate(derived.getvar('SA', 0), derived.getvar('CT', 0), data[0]['data'][0], 188, 4, data[0]['data'][3])
+    assert numpy.allclose(derived.getvar('AOU', 0), aou), 'AOU should match AOU_estimate'
+    assert list(derived.present['AOU']) == [True, False] and derived.hasvar('sigma0', 1), 'derived variables should be present where their inputs are'
+
+    levels = [10, 20]
+    ds = helpers.build_dataset(analysis.interpolate_all(c, levels), levels)
+    derived = analysis.derive_teos10(ds, derived=('CT', 'sigma0'))
+    SA = gsw.SA_from_SP(ds['salinity'].values, numpy.array(levels)[None, :], ds['longitude'].values[:, None], ds['latitude'].values[:, None])
+    CT = gsw.CT_from_t(SA, ds['temperature'].values, numpy.array(levels)[None, :])
+    assert numpy.allclose(derived['sigma0'], gsw.sigma0(SA, CT), equal_nan=True) and 'SA' not in derived, 'datasets should get only the derived variables asked for'
+
+    with pytest.raises(Exception):
+        analysis.derive_teos10(ds, derived=('SA',), salinity='psal')
+
 def test_regional_mean_area_constant():
     lat = [0, 30, 60]
     lon = [10, 20]